@@ -0,0 +1,84 @@
+"""
+Measures how long wb_to_prepbufr.py takes to import and to start up, so that slow imports don't creep back in
+
+Each measurement runs in a fresh interpreter. The script also checks that importing wb_to_prepbufr doesn't load any of
+the heavy dependencies that only some code paths need, and exits with a non-zero status if that, or either time
+limit, fails. To run it from the repository root:
+    python3 benchmarks/startup.py --max_import_ms 300
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# modules that should only be imported once the code path that needs them runs
+LAZY_MODULES = ['requests', 'jwt', 'ncepbufr', 'netCDF4', 'xarray', 'pandas']
+
+
+def import_time_ms():
+    """
+    Cumulative import time of wb_to_prepbufr, as reported by python -X importtime
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import wb_to_prepbufr'],
+                            cwd=REPO_DIR, capture_output=True, text=True, check=True)
+    for line in result.stderr.splitlines():
+        # lines look like "import time:   self [us] |  cumulative | imported package"
+        fields = line.split('|')
+        if len(fields) == 3 and fields[2].strip() == 'wb_to_prepbufr':
+            return int(fields[1]) / 1000
+    raise RuntimeError("wb_to_prepbufr did not show up in the import time report")
+
+
+def startup_time_ms():
+    """
+    Wall time of running the script with --help, from interpreter start to exit
+    """
+    start = time.perf_counter()
+    subprocess.run([sys.executable, 'wb_to_prepbufr.py', '--help'], cwd=REPO_DIR, capture_output=True, check=True)
+    return (time.perf_counter() - start) * 1000
+
+
+def eagerly_imported():
+    code = ('import sys, wb_to_prepbufr\n'
+            f'print(" ".join(name for name in {LAZY_MODULES!r} if name in sys.modules))')
+    result = subprocess.run([sys.executable, '-c', code], cwd=REPO_DIR, capture_output=True, text=True, check=True)
+    return result.stdout.split()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the import and startup time of wb_to_prepbufr.py")
+    parser.add_argument('-n', '--repeats', type=int, default=10, help="Number of fresh interpreters to time")
+    parser.add_argument('--max_import_ms', type=float, help="Fail if the median import time is above this")
+    parser.add_argument('--max_startup_ms', type=float, help="Fail if the median --help run time is above this")
+    args = parser.parse_args()
+
+    import_times = [import_time_ms() for _ in range(args.repeats)]
+    startup_times = [startup_time_ms() for _ in range(args.repeats)]
+    loaded = eagerly_imported()
+
+    print(f"import wb_to_prepbufr: median {statistics.median(import_times):.1f} ms, "
+          f"min {min(import_times):.1f} ms over {args.repeats} run(s)")
+    print(f"wb_to_prepbufr.py --help: median {statistics.median(startup_times):.1f} ms, "
+          f"min {min(startup_times):.1f} ms over {args.repeats} run(s)")
+
+    failed = False
+    if loaded:
+        print(f"FAIL: importing wb_to_prepbufr also imported {', '.join(loaded)}")
+        failed = True
+    if args.max_import_ms is not None and statistics.median(import_times) > args.max_import_ms:
+        print(f"FAIL: import time is above {args.max_import_ms} ms")
+        failed = True
+    if args.max_startup_ms is not None and statistics.median(startup_times) > args.max_startup_ms:
+        print(f"FAIL: startup time is above {args.max_startup_ms} ms")
+        failed = True
+    if failed:
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+"""
+Synthetic super observations, and a local stand-in for the WindBorne API that serves them
+
+The generator flies a number of balloons over a time span, producing observations shaped like the ones the
+super_observations endpoint returns, with some fields missing. The stand-in server pages through them the same
+way the API does, with has_next_page/next_page and the min_time/max_time filters, and can add latency to each
+request. To serve a day of data from 20 balloons on port 8000:
+    python3 benchmarks/synthetic.py --missions 20 --span_hours 24 --port 8000
+and then point wb_to_prepbufr.py at it with WB_API_URL=http://127.0.0.1:8000
+"""
+
+import argparse
+import http.server
+import json
+import threading
+import time
+import urllib.parse
+
+import numpy as np
+
+API_PATH = '/api/v1/super_observations.json'
+
+
+def generate_observations(n_observations, n_missions=20, start_time=1714334400, span_hours=24,
+                          missing_fraction=0.05, seed=0):
+    """
+    Fly n_missions balloons between start_time and start_time + span_hours, with n_observations between them
+    :return: a list of observation dicts, sorted by time as the API returns them
+    """
+    rng = np.random.default_rng(seed)
+    span_seconds = int(span_hours * 60 * 60)
+
+    missions = rng.integers(0, n_missions, n_observations)
+    timestamps = start_time + rng.integers(0, span_seconds, n_observations)
+    order = np.lexsort((timestamps, missions))
+    missions = missions[order]
+    timestamps = timestamps[order]
+
+    # each balloon drifts from its own launch point, moving up and down in altitude as it goes
+    latitude = rng.uniform(-60, 60, n_missions)[missions] + np.cumsum(rng.normal(0, 0.02, n_observations))
+    longitude = rng.uniform(-180, 180, n_missions)[missions] + np.cumsum(rng.normal(0, 0.05, n_observations))
+    latitude = np.clip(latitude, -89.9, 89.9)
+    longitude = (longitude + 180) % 360 - 180
+    altitude = np.clip(rng.uniform(2000, 18000, n_missions)[missions] +
+                       np.cumsum(rng.normal(0, 50, n_observations)), 100, 24000)
+
+    # a standard atmosphere is plenty to keep the thermodynamics plausible
+    pressure = 1013.25 * (1 - altitude / 44330.7) ** 5.255799
+    temperature = np.maximum(15 - 6.5 * altitude / 1000, -56.5) + rng.normal(0, 2, n_observations)
+    humidity = np.clip(rng.normal(50, 25, n_observations), 0, 100)
+    specific_humidity = rng.uniform(0, 15000, n_observations) * np.exp(-altitude / 8000)
+    speed_u = rng.normal(10, 8, n_observations)
+    speed_v = rng.normal(0, 8, n_observations)
+
+    columns = {
+        'altitude': altitude, 'humidity': humidity, 'latitude': latitude, 'longitude': longitude,
+        'pressure': pressure, 'specific_humidity': specific_humidity, 'speed_u': speed_u, 'speed_v': speed_v,
+        'temperature': temperature,
+    }
+    missing = {name: rng.random(n_observations) < missing_fraction for name in columns}
+    # the converters need at least one of pressure and altitude
+    missing['altitude'] &= ~missing['pressure']
+
+    observations = []
+    for i in np.argsort(timestamps, kind='stable'):
+        observation = {name: None if missing[name][i] else round(float(values[i]), 4)
+                       for name, values in columns.items()}
+        observation['timestamp'] = int(timestamps[i])
+        observation['mission_name'] = f"W-{1000 + missions[i]}"
+        observations.append(observation)
+    return observations
+
+
+class StandInAPI:
+    """
+    Serves observations from a local HTTP server, paginated like the super_observations endpoint
+    """
+
+    def __init__(self, observations, page_size=1000, latency_seconds=0.0, port=0):
+        self.observations = observations
+        self.timestamps = np.array([observation['timestamp'] for observation in observations])
+        self.page_size = page_size
+        self.latency_seconds = latency_seconds
+        self.requests = 0
+
+        api = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                api.requests += 1
+                time.sleep(api.latency_seconds)
+
+                url = urllib.parse.urlsplit(self.path)
+                query = dict(urllib.parse.parse_qsl(url.query))
+                if url.path != API_PATH:
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+
+                body = json.dumps(api.page(query)).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def page(self, query):
+        """
+        One page of observations between min_time and max_time, starting at the cursor
+        """
+        first = np.searchsorted(self.timestamps, int(query.get('min_time', self.timestamps[0])), side='left')
+        last = np.searchsorted(self.timestamps, int(query.get('max_time', self.timestamps[-1])), side='right')
+        start = first + int(query.get('cursor', 0))
+        end = min(start + self.page_size, last)
+
+        observations = self.observations[start:end]
+        if query.get('include_mission_name') != 'true':
+            observations = [{key: value for key, value in observation.items() if key != 'mission_name'}
+                            for observation in observations]
+        return {
+            'observations': observations,
+            'has_next_page': bool(end < last),
+            'next_page': f"{self.url}{API_PATH}?cursor={end - first}",
+        }
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve synthetic super observations from a local stand-in API")
+    parser.add_argument('-n', '--observations', type=int, default=100000)
+    parser.add_argument('--missions', type=int, default=20)
+    parser.add_argument('--start_time', type=int, default=1714334400, help="Unix time of the first observation")
+    parser.add_argument('--span_hours', type=float, default=24)
+    parser.add_argument('--missing_fraction', type=float, default=0.05)
+    parser.add_argument('--page_size', type=int, default=1000)
+    parser.add_argument('--latency_ms', type=float, default=0)
+    parser.add_argument('--port', type=int, default=8000)
+    args = parser.parse_args()
+
+    observations = generate_observations(args.observations, args.missions, args.start_time, args.span_hours,
+                                         args.missing_fraction)
+    api = StandInAPI(observations, args.page_size, args.latency_ms / 1000, args.port)
+    print(f"Serving {len(observations)} observation(s) at {api.url}{API_PATH}")
+    api.server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+"""
+Times each stage of the pipeline separately on synthetic data, reporting observations per second and peak memory
+
+The stages are:
+    paging     fetching every page from the local stand-in API through WindBorneClient
+    grouping   packing pages into columns, splitting by mission and sorting by time
+    bucketing  output_data's split into time buckets, with a writer that does nothing
+    prepbufr   writing every bucket with convert_to_prepbufr (needs ncepbufr)
+    netcdf     writing every bucket with convert_to_netcdf (needs netCDF4)
+    verify     reading every bucket's prepbufr file back and checking it with verify_prepbufr (needs ncepbufr)
+Each stage runs in its own process, so its peak RSS isn't inflated by the stages before it; note that the peak
+includes the synthetic input itself. To run from the repository root:
+    python3 benchmarks/throughput.py --observations 200000 --missions 50 --span_hours 72
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, REPO_DIR)
+
+import synthetic
+import wb_to_prepbufr
+
+STAGES = ['paging', 'grouping', 'bucketing', 'prepbufr', 'netcdf', 'verify']
+
+
+@wb_to_prepbufr.register_writer('null', lambda mission_name, curtime, bucket_hours: os.devnull)
+def write_nothing(segment, mission_name, curtime, bucket_hours, **options):
+    pass
+
+
+def pages(observations, page_size):
+    return [observations[start:start + page_size] for start in range(0, len(observations), page_size)]
+
+
+def grouped(observations, page_size):
+    collector = wb_to_prepbufr.ObservationCollector()
+    for page in pages(observations, page_size):
+        collector.add_page(page)
+    return collector.observations().split_by_mission()
+
+
+def write_all(by_mission, bucket_hours, output_format):
+    for mission_name, mission_observations in by_mission.items():
+        wb_to_prepbufr.output_data(mission_observations, mission_name, 0, bucket_hours, output_format)
+
+
+def verify_all(by_mission, bucket_hours):
+    """
+    Write every bucket as prepbufr, then time reading them all back and checking them
+    """
+    written = []
+    for mission_name, mission_observations in by_mission.items():
+        mission_observations = mission_observations.sort_by_time()
+        for curtime, start_index, end_index in wb_to_prepbufr.bucket_segments(mission_observations['timestamp'],
+                                                                              bucket_hours):
+            segment = mission_observations[start_index:end_index]
+            reftime = curtime + bucket_hours * 60 * 60 // 2
+            output_file = wb_to_prepbufr.bucket_output_file(mission_name, curtime, bucket_hours)
+            wb_to_prepbufr.convert_to_prepbufr(segment, reftime, output_file)
+            written.append((output_file, segment, reftime))
+
+    start = time.perf_counter()
+    for output_file, segment, reftime in written:
+        verification = wb_to_prepbufr.verify_prepbufr(output_file, segment, reftime)
+        if verification['mismatches']:
+            raise RuntimeError(f"{output_file} didn't verify: {verification['mismatches']}")
+    return time.perf_counter() - start
+
+
+def run_stage(stage, args):
+    """
+    Run one stage in this process
+    :return: the number of observations processed and the seconds it took
+    """
+    observations = synthetic.generate_observations(args.observations, args.missions, span_hours=args.span_hours,
+                                                   missing_fraction=args.missing_fraction)
+
+    if stage == 'paging':
+        api = synthetic.StandInAPI(observations, args.page_size, args.latency_ms / 1000).start()
+        wb_to_prepbufr.API_URL = api.url
+        client = wb_to_prepbufr.WindBorneClient('benchmark', 'benchmark-key-that-is-long-enough-for-hs256')
+        starttime = observations[0]['timestamp']
+        endtime = observations[-1]['timestamp']
+
+        start = time.perf_counter()
+        count = 0
+        next_page = wb_to_prepbufr.super_observations_url(starttime, endtime)
+        for _, page in client.iter_pages(next_page, lambda page: wb_to_prepbufr.next_super_observations_url(
+                page, starttime, endtime)):
+            count += len(page['observations'])
+        seconds = time.perf_counter() - start
+        api.stop()
+        return count, seconds
+
+    if stage == 'grouping':
+        page_list = pages(observations, args.page_size)
+        start = time.perf_counter()
+        collector = wb_to_prepbufr.ObservationCollector()
+        for page in page_list:
+            collector.add_page(page)
+        for mission_observations in collector.observations().split_by_mission().values():
+            mission_observations.sort_by_time()
+        return len(observations), time.perf_counter() - start
+
+    by_mission = grouped(observations, args.page_size)
+    output_format = 'null' if stage == 'bucketing' else stage
+    if stage in ('prepbufr', 'verify'):
+        import ncepbufr
+    if stage == 'netcdf':
+        import netCDF4
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        os.symlink(os.path.join(REPO_DIR, 'prepbufr_config.table'), os.path.join(output_dir, 'prepbufr_config.table'))
+        os.chdir(output_dir)
+        with open(os.devnull, 'w') as devnull:
+            stdout, sys.stdout = sys.stdout, devnull
+            try:
+                if stage == 'verify':
+                    seconds = verify_all(by_mission, args.bucket_hours)
+                else:
+                    start = time.perf_counter()
+                    write_all(by_mission, args.bucket_hours, output_format)
+                    seconds = time.perf_counter() - start
+            finally:
+                sys.stdout = stdout
+        os.chdir(REPO_DIR)
+    return len(observations), seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the throughput of each stage of wb_to_prepbufr.py")
+    parser.add_argument('-n', '--observations', type=int, default=100000)
+    parser.add_argument('--missions', type=int, default=20)
+    parser.add_argument('--span_hours', type=float, default=48)
+    parser.add_argument('--missing_fraction', type=float, default=0.05)
+    parser.add_argument('--page_size', type=int, default=1000)
+    parser.add_argument('--latency_ms', type=float, default=20, help="Latency the stand-in API adds to each page")
+    parser.add_argument('-b', '--bucket_hours', type=float, default=6.0)
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES)
+    parser.add_argument('--json', help="Also write the results to this file as JSON")
+    parser.add_argument('--stage', choices=STAGES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.stage is not None:
+        # we are the child process for a single stage
+        try:
+            count, seconds = run_stage(args.stage, args)
+            result = {'observations': count, 'seconds': seconds}
+        except ImportError as e:
+            result = {'skipped': str(e)}
+        result['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        print(json.dumps(result))
+        return
+
+    child_args = list(sys.argv[1:])
+    results = {}
+    print(f"{'stage':<10} {'observations':>12} {'seconds':>9} {'obs/s':>11} {'peak RSS MB':>12}")
+    for stage in args.stages:
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), *child_args, '--stage', stage],
+                                capture_output=True, text=True, check=True).stdout
+        result = results[stage] = json.loads(output.splitlines()[-1])
+        if 'skipped' in result:
+            print(f"{stage:<10} skipped: {result['skipped']}")
+            continue
+        result['observations_per_second'] = result['observations'] / result['seconds']
+        print(f"{stage:<10} {result['observations']:>12} {result['seconds']:>9.3f} "
+              f"{result['observations_per_second']:>11.0f} {result['peak_rss_mb']:>12.1f}")
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
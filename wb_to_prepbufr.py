@@ -1,13 +1,143 @@
 import os
 import time
+import threading
+import concurrent.futures
 import datetime
+import gzip
+import hashlib
+import importlib
+import itertools
+import json
+import tempfile
+import urllib.parse
+import collections
+import contextlib
 import numpy as np
-import jwt
-import requests
-import ncepbufr
 import argparse
-import xarray as xr
-import pandas as pd
+
+# The heavier dependencies (requests, jwt, ncepbufr and netCDF4) are imported where they are used,
+# so a run only pays to import what it actually needs
+
+"""
+In this section, we keep track of how long each stage of a run takes and how much it did, so that
+slowdowns show up in a machine-readable report rather than only in the printed output
+"""
+
+
+class RunReport:
+    """
+    Collects timings and counters for a run, and writes them out as JSON and/or a Prometheus textfile
+    Counters and timings are running totals; only the last max_history pages and buckets are kept individually,
+    so a long --poll run doesn't grow without limit
+    Safe to update from several threads at once
+    """
+
+    def __init__(self, json_file=None, prometheus_file=None, max_history=1000):
+        self.json_file = json_file
+        self.prometheus_file = prometheus_file
+        self.started = time.time()
+        self.counters = collections.Counter()
+        self.stage_seconds = collections.Counter()
+        self.pages = collections.deque(maxlen=max_history)
+        self.buckets = collections.deque(maxlen=max_history)
+        self.page_seconds_total = 0.0
+        self.page_seconds_max = None
+        self._lock = threading.Lock()
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Time a block of code, adding it to the total for the named stage
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.stage_seconds[name] += time.perf_counter() - start
+
+    def record_page(self, url, seconds, size):
+        with self._lock:
+            self.counters['pages_fetched'] += 1
+            self.counters['page_bytes'] += size
+            self.page_seconds_total += seconds
+            self.page_seconds_max = seconds if self.page_seconds_max is None else max(self.page_seconds_max, seconds)
+            self.pages.append({'url': url, 'seconds': seconds, 'bytes': size})
+
+    def record_bucket(self, stats):
+        """
+        Record a bucket written by write_segment, from the stats it returned
+        """
+        with self._lock:
+            self.counters['buckets_written'] += 1
+            self.counters['observations_written'] += stats['observations'] - stats.get('rejected', 0)
+            self.counters['observations_thinned'] += stats.get('thinned', 0)
+            self.counters['observations_rejected'] += stats.get('rejected', 0)
+            self.counters['messages_written'] += stats.get('messages', 0)
+            self.counters['subsets_written'] += stats.get('subsets', 0)
+            self.counters['output_bytes'] += stats['bytes']
+            self.stage_seconds['conversion'] += stats['seconds'] - stats.get('verify_seconds', 0)
+            if 'subsets_verified' in stats:
+                self.counters['subsets_verified'] += stats['subsets_verified']
+                self.counters['verify_mismatches'] += stats['verify_mismatches']
+                self.stage_seconds['verification'] += stats['verify_seconds']
+            self.buckets.append(stats)
+
+    def summary(self):
+        with self._lock:
+            pages_fetched = self.counters['pages_fetched']
+            return {
+                'started': datetime.datetime.fromtimestamp(self.started, tz=datetime.timezone.utc).isoformat(),
+                'duration_seconds': time.time() - self.started,
+                'counters': dict(self.counters),
+                'stage_seconds': dict(self.stage_seconds),
+                'page_fetch_seconds': {
+                    'mean': self.page_seconds_total / pages_fetched if pages_fetched else None,
+                    'max': self.page_seconds_max,
+                },
+                'pages': list(self.pages),
+                'buckets': list(self.buckets),
+            }
+
+    def prometheus_text(self, summary):
+        lines = []
+
+        def metric(name, value, help_text, labels=''):
+            if not any(line.startswith(f"# TYPE wb_to_prepbufr_{name} ") for line in lines):
+                lines.append(f"# HELP wb_to_prepbufr_{name} {help_text}")
+                lines.append(f"# TYPE wb_to_prepbufr_{name} gauge")
+            lines.append(f"wb_to_prepbufr_{name}{labels} {value}")
+
+        metric('last_run_timestamp_seconds', self.started, "When the last run started")
+        metric('run_duration_seconds', summary['duration_seconds'], "How long the last run took")
+        for name, value in sorted(summary['counters'].items()):
+            metric(name, value, f"{name.replace('_', ' ').capitalize()} in the last run")
+        for name, seconds in sorted(summary['stage_seconds'].items()):
+            metric('stage_seconds', seconds, "Time spent in each stage of the last run", f'{{stage="{name}"}}')
+        for statistic, seconds in summary['page_fetch_seconds'].items():
+            if seconds is not None:
+                metric(f'page_fetch_seconds_{statistic}', seconds, f"The {statistic} time to fetch a page")
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        """
+        Write the report to whichever of the JSON and Prometheus files were asked for
+        Each is written to a temporary file and moved into place, so readers never see a partial report
+        """
+        summary = self.summary()
+        if self.json_file is not None:
+            with open(self.json_file + '.tmp', 'w') as f:
+                json.dump(summary, f, indent=2)
+            os.replace(self.json_file + '.tmp', self.json_file)
+        if self.prometheus_file is not None:
+            with open(self.prometheus_file + '.tmp', 'w') as f:
+                f.write(self.prometheus_text(summary))
+            os.replace(self.prometheus_file + '.tmp', self.prometheus_file)
+
 
 """
 In this section, we define the helper functions to access the WindBorne API
@@ -15,31 +145,441 @@ This is described in https://windbornesystems.com/docs/api
 """
 
 
+# where to find the API; this can be pointed elsewhere, eg at the stand-in server in benchmarks/synthetic.py
+API_URL = os.environ.get('WB_API_URL', 'https://sensor-data.windbornesystems.com')
+
+# transient failures worth retrying rather than giving up on the whole run
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class PageCache:
+    """
+    An on-disk cache of API responses, so re-running over the same window doesn't refetch every page
+    Pages are stored gzipped under a hash of the url with its query parameters sorted, and the least
+    recently used pages are evicted once the cache grows past max_bytes
+    Pages never expire, so the last page of a window is only cached once the window ended settle_hours ago;
+    until then more observations can still turn up on it
+    """
+
+    def __init__(self, directory, max_bytes=1024 ** 3, settle_hours=6.0):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.settle_hours = settle_hours
+        self._lock = threading.Lock()
+
+        # key -> (last used, size in bytes)
+        self._entries = {}
+        os.makedirs(directory, exist_ok=True)
+        for entry in os.scandir(directory):
+            if entry.name.endswith('.json.gz'):
+                stat = entry.stat()
+                self._entries[entry.name[:-len('.json.gz')]] = (stat.st_mtime, stat.st_size)
+
+    @staticmethod
+    def key(url):
+        """
+        Hash the url with its query parameters in a canonical order
+        """
+        parts = urllib.parse.urlsplit(url)
+        query = urllib.parse.urlencode(sorted(urllib.parse.parse_qsl(parts.query, keep_blank_values=True)))
+        normalized = urllib.parse.urlunsplit((parts.scheme, parts.netloc, parts.path, query, ''))
+        return hashlib.sha256(normalized.encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.json.gz')
+
+    def cacheable(self, url, page):
+        """
+        Whether a page can be cached: any page but the last of its window, or the last once the window has
+        settled. A window with no max_time, as polling uses, never settles
+        """
+        if page.get('has_next_page'):
+            return True
+        max_time = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(url).query)).get('max_time')
+        return max_time is not None and int(max_time) + self.settle_hours * 60 * 60 <= time.time()
+
+    def get(self, url):
+        """
+        :return: the cached page for url, or None if it isn't cached
+        """
+        key = self.key(url)
+        with self._lock:
+            if key not in self._entries:
+                return None
+            try:
+                with gzip.open(self._path(key), 'rt') as f:
+                    page = json.load(f)
+            except (OSError, ValueError):
+                # treat a missing or corrupt file as a miss
+                del self._entries[key]
+                return None
+
+            now = time.time()
+            os.utime(self._path(key), (now, now))
+            self._entries[key] = (now, self._entries[key][1])
+            return page
+
+    def put(self, url, page):
+        key = self.key(url)
+        path = self._path(key)
+        with self._lock:
+            # write to a temporary file first so a crash never leaves a truncated page behind
+            with gzip.open(path + '.tmp', 'wt') as f:
+                json.dump(page, f)
+            os.replace(path + '.tmp', path)
+            self._entries[key] = (time.time(), os.path.getsize(path))
+            self._evict()
+
+    def _evict(self):
+        total = sum(size for _, size in self._entries.values())
+        for key, (_, size) in sorted(self._entries.items(), key=lambda entry: entry[1][0]):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+            del self._entries[key]
+            total -= size
+
+
+class WindBorneClient:
+    """
+    Makes GET requests to WindBorne, authorizing with WindBorne correctly
+    A single client keeps one pooled connection open across requests, reuses its signed token until it is
+    close to expiring, and retries transient failures with exponential backoff
+
+    If given a PageCache, pages are served from it when possible and saved to it when fetched
+    With offline=True, only the cache is used and no credentials are needed
+    """
+
+    def __init__(self, client_id=None, api_key=None, token_lifetime=300, max_retries=3, backoff_seconds=1.0,
+                 timeout=60, cache=None, offline=False, report=None, pool_maxsize=10):
+        """
+        :param pool_maxsize: how many connections to keep open, which should be at least the number of threads
+                             fetching pages at once
+        """
+        if offline and cache is None:
+            raise ValueError("offline mode needs a page cache to replay from")
+        self.cache = cache
+        self.offline = offline
+        self.report = report
+
+        self.client_id = client_id or os.environ.get('WB_CLIENT_ID')  # Make sure to set this!
+        self.api_key = api_key or os.environ.get('WB_API_KEY')  # Make sure to set this!
+        if not offline and (self.client_id is None or self.api_key is None):
+            raise KeyError("WB_CLIENT_ID and WB_API_KEY must be set")
+        self.token_lifetime = token_lifetime
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.timeout = timeout
+
+        import requests
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_maxsize)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._token_lock = threading.Lock()
+        self._signed_token = None
+        self._signed_at = 0
+
+    def signed_token(self):
+        """
+        Return a signed JSON Web Token for authentication, signing a new one only when the last is near expiry
+        This token is safe to pass to other processes or servers if desired, as it does not expose the API key
+        """
+        import jwt
+
+        with self._token_lock:
+            now = time.time()
+            if self._signed_token is None or now - self._signed_at > self.token_lifetime * 0.8:
+                self._signed_at = now
+                self._signed_token = jwt.encode({
+                    'client_id': self.client_id,
+                    'iat': int(now),
+                }, self.api_key, algorithm='HS256')
+            return self._signed_token
+
+    def get(self, url):
+        """
+        Make a GET request, retrying connection errors, timeouts, rate limits and server errors
+        :return: the decoded JSON response body
+        """
+        import requests
+
+        if self.cache is not None:
+            page = self.cache.get(url)
+            if page is not None:
+                if self.report is not None:
+                    self.report.count('pages_from_cache')
+                return page
+            if self.offline:
+                raise LookupError(f"{url} is not in the page cache, so it can't be replayed offline")
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                start = time.perf_counter()
+                response = self.session.get(url, auth=(self.client_id, self.signed_token()), timeout=self.timeout)
+                if response.status_code not in RETRY_STATUS_CODES:
+                    # make sure the request succeeded, and return the response body
+                    response.raise_for_status()
+                    page = response.json()
+                    if self.report is not None:
+                        self.report.record_page(url, time.perf_counter() - start, len(response.content))
+                    if self.cache is not None and self.cache.cacheable(url, page):
+                        self.cache.put(url, page)
+                    return page
+                error = requests.HTTPError(f"{response.status_code} response from {url}", response=response)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+
+            if self.report is not None:
+                self.report.count('request_failures')
+            if attempt == self.max_retries:
+                raise error
+            delay = self.backoff_seconds * 2 ** attempt
+            print(f"Request failed ({error}); retrying in {delay:.0f}s")
+            time.sleep(delay)
+
+    def iter_pages(self, url, next_page_url):
+        """
+        Yield (url, page) for each page of a paginated endpoint
+        While the caller is working on one page, the next one is already being fetched in the background
+        :param next_page_url: function taking a page and returning the url of the following page, or None at the end
+        """
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        try:
+            future = executor.submit(self.get, url)
+            while url is not None:
+                page = future.result()
+                following_url = next_page_url(page)
+                if following_url is not None:
+                    future = executor.submit(self.get, following_url)
+                yield url, page
+                url = following_url
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+_default_client = None
+
+
 def wb_get_request(url):
     """
     Make a GET request to WindBorne, authorizing with WindBorne correctly
     """
+    global _default_client
+    if _default_client is None:
+        _default_client = WindBorneClient()
+    return _default_client.get(url)
+
+
+def super_observations_url(starttime, endtime=None):
+    """
+    The first page of super observations between starttime and endtime (or with no end, if endtime is None)
+    """
+    if endtime is None:
+        return f"{API_URL}/api/v1/super_observations.json?min_time={starttime}&include_mission_name=true"
+    return f"{API_URL}/api/v1/super_observations.json?min_time={starttime}&max_time={endtime}&include_mission_name=true"
+
+
+def next_super_observations_url(observations_page, starttime, endtime=None, poll=False):
+    """
+    The page following observations_page, or None if it is the last one
+    With poll=True, the last page's next_page is returned too, as that is where new data will show up
+    """
+    if not observations_page["has_next_page"] and not (poll and observations_page.get("next_page")):
+        return None
+    if endtime is None:
+        return observations_page["next_page"]+"&include_mission_name=true&min_time={}".format(starttime)
+    return observations_page["next_page"]+"&include_mission_name=true&min_time={}&max_time={}".format(starttime,endtime)
+
+"""
+In this section, we define the columnar container that observations are kept in once fetched
+Rather than keeping a dict per observation, each page from the API is packed into a structured numpy array,
+with missing values as NaN and the mission name stored as an integer code into a shared list of names
+"""
+
+OBSERVATION_DTYPE = np.dtype([
+    ('timestamp', np.int64),
+    ('latitude', np.float64),
+    ('longitude', np.float64),
+    ('altitude', np.float64),
+    ('pressure', np.float64),
+    ('temperature', np.float64),
+    ('humidity', np.float64),
+    ('specific_humidity', np.float64),
+    ('speed_u', np.float64),
+    ('speed_v', np.float64),
+    ('mission', np.int32),
+])
+
+OBSERVATION_FIELDS = [name for name in OBSERVATION_DTYPE.names if name not in ('timestamp', 'mission')]
 
-    client_id = os.environ['WB_CLIENT_ID']  # Make sure to set this!
-    api_key = os.environ['WB_API_KEY']  # Make sure to set this!
 
-    # create a signed JSON Web Token for authentication
-    # this token is safe to pass to other processes or servers if desired, as it does not expose the API key
-    signed_token = jwt.encode({
-        'client_id': client_id,
-        'iat': int(time.time()),
-    }, api_key, algorithm='HS256')
+class Observations:
+    """
+    A set of observations stored column-wise
+    Index with a field name to get that column (eg observations['pressure']), or with a slice,
+    mask or index array to get a subset that shares the same mission names
+    """
+
+    def __init__(self, data=None, mission_names=None):
+        self.data = np.empty(0, dtype=OBSERVATION_DTYPE) if data is None else data
+        self.mission_names = [] if mission_names is None else mission_names
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.data[key]
+        return Observations(np.atleast_1d(self.data[key]), self.mission_names)
+
+    def mission_name(self, i):
+        return self.mission_names[self.data['mission'][i]]
+
+    @staticmethod
+    def concatenate(parts):
+        """
+        Join several sets of observations that share the same mission names into one
+        """
+        return Observations(np.concatenate([part.data for part in parts]), parts[0].mission_names)
+
+    def drop_duplicates(self):
+        """
+        Return these observations with repeats of the same (mission, timestamp) removed, keeping the first of each
+        """
+        _, first = np.unique(self.data[['mission', 'timestamp']], return_index=True)
+        if len(first) == len(self):
+            return self
+        return self[np.sort(first)]
+
+    def sort_by_time(self):
+        """
+        Return these observations in time order; the sort is stable, so ties keep the order they were fetched in
+        The API pages in time order, so observations are usually in order already and are returned as they are,
+        without a copy; otherwise numpy's stable sort merges the runs that are already in order
+        """
+        timestamps = self.data['timestamp']
+        if not np.any(timestamps[1:] < timestamps[:-1]):
+            return self
+        return self[np.argsort(timestamps, kind='stable')]
+
+    def split_by_mission(self):
+        """
+        Return a dict of mission name -> observations for that mission, in the order missions were first seen
+        """
+        order = np.argsort(self.data['mission'], kind='stable')
+        codes = self.data['mission'][order]
+        boundaries = np.flatnonzero(np.diff(codes)) + 1
+        return {self.mission_names[group[0]]: self[order[start:end]]
+                for group, start, end in zip(np.split(codes, boundaries),
+                                             np.concatenate(([0], boundaries)),
+                                             np.concatenate((boundaries, [len(codes)])))}
+
+
+class ObservationCollector:
+    """
+    Builds up an Observations container page by page from the API's JSON
+    """
 
-    # make the request, checking the status code to make sure it succeeded
-    response = requests.get(url, auth=(client_id, signed_token))
-    response.raise_for_status()
+    def __init__(self):
+        self.mission_names = []
+        self._mission_codes = {}
+        self._pages = []
+
+    def add_page(self, observations):
+        """
+        Pack one page of observation dicts into columns
+        :return: the number of observations dropped for having no mission name
+        """
+
+        total = len(observations)
+        observations = [observation for observation in observations if 'mission_name' in observation]
+
+        page = np.empty(len(observations), dtype=OBSERVATION_DTYPE)
+        page['timestamp'] = [observation['timestamp'] for observation in observations]
+        for field in OBSERVATION_FIELDS:
+            page[field] = [np.nan if observation.get(field) is None else observation[field]
+                           for observation in observations]
+
+        for observation in observations:
+            if observation['mission_name'] not in self._mission_codes:
+                self._mission_codes[observation['mission_name']] = len(self.mission_names)
+                self.mission_names.append(observation['mission_name'])
+        page['mission'] = [self._mission_codes[observation['mission_name']] for observation in observations]
+
+        self._pages.append(page)
+        return total - len(observations)
+
+    def add_observations(self, observations):
+        """
+        Add observations collected by another collector, recoding their missions to this collector's codes
+        """
+        for mission_name in observations.mission_names:
+            if mission_name not in self._mission_codes:
+                self._mission_codes[mission_name] = len(self.mission_names)
+                self.mission_names.append(mission_name)
+        codes = np.array([self._mission_codes[mission_name] for mission_name in observations.mission_names],
+                         dtype=OBSERVATION_DTYPE['mission'])
+        data = observations.data.copy()
+        data['mission'] = codes[data['mission']]
+        self._pages.append(data)
+
+    def observations(self):
+        if len(self._pages) == 0:
+            return Observations(mission_names=self.mission_names)
+        return Observations(np.concatenate(self._pages), self.mission_names)
+
+    def drain(self):
+        """
+        Return the observations collected so far and start collecting afresh, keeping the same mission codes
+        """
+        observations = self.observations()
+        self._pages = []
+        return observations
+
+
+def to_observations(observations, mission_names=None):
+    """
+    Turn observations in any of the shapes the library API accepts into an Observations container:
+    - an Observations container, which is returned as it is
+    - an iterable of observation dicts shaped like the API's, each with a mission_name
+    - a dict of columns named as in the API, with a mission_name column of strings; missing values are NaN
+    - a structured numpy array with OBSERVATION_DTYPE, whose mission codes index into mission_names
+    """
+    if isinstance(observations, Observations):
+        return observations
+
+    if isinstance(observations, np.ndarray):
+        if mission_names is None:
+            raise ValueError("mission_names is needed for the mission codes in an OBSERVATION_DTYPE array")
+        return Observations(observations.astype(OBSERVATION_DTYPE, copy=False), list(mission_names))
+
+    if isinstance(observations, dict):
+        mission_names, codes = np.unique(np.asarray(observations['mission_name'], dtype=str), return_inverse=True)
+        data = np.empty(len(codes), dtype=OBSERVATION_DTYPE)
+        data['timestamp'] = observations['timestamp']
+        for field in OBSERVATION_FIELDS:
+            data[field] = observations[field] if field in observations else np.nan
+        data['mission'] = codes
+        return Observations(data, mission_names.tolist())
+
+    # pack an iterable of dicts a page at a time, so a generator is never held in memory as dicts all at once
+    collector = ObservationCollector()
+    observations = iter(observations)
+    while True:
+        page = list(itertools.islice(observations, 10000))
+        if len(page) == 0:
+            return collector.observations()
+        collector.add_page(page)
 
-    # return the response body
-    return response.json()
 
 """
 These are the observation error values for radiosondes that were taken 
 from NCEP'S GSI data tables.  
+They are the defaults for ObservationErrorModel, which can also load a full errtable file instead.
 
 The first table has error values for the thermodynamics (P, T, RH)
 column 1: pressure level (hPa),
@@ -123,24 +663,89 @@ error_winds_str = """
   0.10000E+01 0.10000E+10 0.10000E+10 0.21000E+01 0.10000E+10 0.10000E+10
   0.00000E+00 0.10000E+10 0.10000E+10 0.21000E+01 0.10000E+10 0.10000E+10"""
 
-"""
-Some quick parsing here, in order to get the data into variables
-"""
-error_thermo_vals = np.fromstring(error_thermo_str, sep=' ')
-error_thermo_vals.shape = (len(error_thermo_vals)//6, 6)
-error_thermo_vals = np.flipud(error_thermo_vals)
-error_thermo = {}
-error_thermo["pressure"] = error_thermo_vals[:, 0]
-error_thermo["temp"] = error_thermo_vals[:, 1]
-error_thermo["rh"] = error_thermo_vals[:, 2] * 10
-
-error_winds_vals = np.fromstring(error_winds_str, sep=' ')
-error_winds_vals.shape = (len(error_winds_vals)//6, 6)
-error_winds_vals = np.flipud(error_winds_vals)
-error_winds = {}
-error_winds["pressure"] = error_winds_vals[:, 0]
-error_winds["speed"] = error_winds_vals[:, 3]
-assert (error_thermo["pressure"] == error_winds["pressure"]).all()
+
+
+def parse_errtable_rows(text):
+    """
+    Parse the numeric rows of one block of a GSI errtable into an array with one row per pressure level
+    """
+    return np.array(text.split(), dtype=float).reshape(-1, 6)
+
+
+def read_errtable(path):
+    """
+    Read a standard GSI errtable file
+    :return: a dict of observation type -> its rows, as from parse_errtable_rows
+    """
+    blocks = {}
+    observation_type = None
+    with open(path) as f:
+        for line in f:
+            if 'OBSERVATION TYPE' in line:
+                observation_type = int(line.split()[0])
+                blocks[observation_type] = []
+            elif line.strip() and observation_type is not None:
+                blocks[observation_type].append(line)
+    return {observation_type: parse_errtable_rows(''.join(lines)) for observation_type, lines in blocks.items()}
+
+
+_default_error_model = None
+
+
+class ObservationErrorModel:
+    """
+    Looks up observation errors by pressure level for whole segments of observations at once
+    The thermodynamic errors come from one errtable block (columns 2 and 3) and the wind errors from another (column 4)
+    """
+
+    def __init__(self, thermo_rows, wind_rows):
+        # np.interp needs the pressure levels in increasing order
+        thermo_rows = thermo_rows[np.argsort(thermo_rows[:, 0], kind='stable')]
+        wind_rows = wind_rows[np.argsort(wind_rows[:, 0], kind='stable')]
+
+        self.thermo_pressure = thermo_rows[:, 0]
+        self.temperature_error = thermo_rows[:, 1]
+        self.rh_error = thermo_rows[:, 2] * 10
+        self.wind_pressure = wind_rows[:, 0]
+        self.wind_error = wind_rows[:, 3]
+
+    @classmethod
+    def default(cls):
+        """
+        The radiosonde errors built into this file, parsed the first time they are needed
+        """
+        global _default_error_model
+        if _default_error_model is None:
+            _default_error_model = cls(parse_errtable_rows(error_thermo_str), parse_errtable_rows(error_winds_str))
+        return _default_error_model
+
+    @classmethod
+    def from_errtable(cls, path, thermo_type=120, wind_type=220):
+        """
+        Load errors from a GSI errtable file, by default using the radiosonde blocks
+        """
+        blocks = read_errtable(path)
+        return cls(blocks[thermo_type], blocks[wind_type])
+
+    @staticmethod
+    def estimate_pressure(altitude):
+        """
+        Just a quick estimate of pressure (hPa) from altitude (m), close enough for error characteristics
+        """
+        return 3.83325e-22 * (44330.7 - np.asarray(altitude, dtype=float))**5.255799
+
+    def errors(self, pressure, altitude):
+        """
+        Look up errors for each observation, estimating pressure from altitude where it is missing
+        :return: wind speed error (m/s), temperature error (K) and relative humidity error (%) arrays
+        """
+        pressure = np.asarray(pressure, dtype=float)
+        interp_pressure = np.where(np.isnan(pressure), self.estimate_pressure(altitude), pressure)
+
+        wind_error = np.interp(interp_pressure, self.wind_pressure, self.wind_error)
+        temperature_error = np.interp(interp_pressure, self.thermo_pressure, self.temperature_error)
+        rh_error = np.interp(interp_pressure, self.thermo_pressure, self.rh_error)
+        return wind_error, temperature_error, rh_error
 
 """
 In this section, we have the core functions to convert data to prepbufr
@@ -156,46 +761,338 @@ RVGAS = 461.50
 EPS = RDGAS / RVGAS
 
 
-@np.vectorize
 def gfssvp(temperature_celsius):
     """
     Calculate saturation vapor pressure with GFS formula
     Note this is slightly different from other formulas you'll see
     So, you may wish to replace this function, or to replace to relative humidity -> specific humidity calc entirely
+
+    Works on scalars or whole arrays at once; NaN temperatures give NaN
     """
 
-    temperature_kelvin = temperature_celsius + 273.15
-    esice = 0
+    temperature_kelvin = np.asarray(temperature_celsius, dtype=float) + 273.15
+
+    # over ice, only needed below freezing
+    ice = temperature_kelvin < TBASI
+    esice = np.zeros_like(temperature_kelvin)
+    t = temperature_kelvin[ice]
+    x = -9.09718 * (TBASI / t - 1.0) - 3.56654 * np.log10(TBASI / t) + 0.876793 * (1.0 - t / TBASI) + np.log10(ESBASI)
+    esice[ice] = 10. ** x
+
+    # over water, only needed above -20C
+    water = temperature_kelvin > TBASI - 20
+    esh2o = np.zeros_like(temperature_kelvin)
+    t = temperature_kelvin[water]
+    x = -7.90298 * (TBASW / t - 1.0) + 5.02808 * np.log10(TBASW / t) \
+        - 1.3816e-07 * (10.0 ** ((1.0 - t / TBASW) * 11.344) - 1.0) \
+        + 8.1328e-03 * (10.0 ** ((TBASW / t - 1.0) * (-3.49149)) - 1.0) \
+        + np.log10(ESBASW)
+    esh2o[water] = 10. ** x
+
+    # blend linearly between the two from -20C to 0C
+    es = 0.05 * ((TBASI - temperature_kelvin) * esice + (temperature_kelvin - TBASI + 20.) * esh2o)
+    es = np.where(temperature_kelvin <= -20 + TBASI, esice, es)
+    es = np.where(temperature_kelvin >= TBASI, esh2o, es)
+    es[np.isnan(temperature_kelvin)] = np.nan
+    return es[()]
+
+
+def relative_to_specific_humidity(temperature_celsius, pressure_hpa, relative_humidity):
+    """
+    Convert relative humidity (%) to specific humidity (mg/kg) for whole arrays of observations
+    Missing values should be passed as NaN, and any observation missing temperature, pressure or humidity
+    comes back as NaN
+    """
 
-    if temperature_kelvin < TBASI:
-        x = -9.09718 * (TBASI / temperature_kelvin - 1.0) - 3.56654 * np.log10(
-            TBASI / temperature_kelvin) + 0.876793 * (1.0 - temperature_kelvin / TBASI) + np.log10(
-            ESBASI)
-        esice = 10. ** x
+    temperature_celsius = np.asarray(temperature_celsius, dtype=float)
+    pressure_hpa = np.asarray(pressure_hpa, dtype=float)
+    relative_humidity = np.asarray(relative_humidity, dtype=float)
 
-    esh2o = 0
-    if temperature_kelvin > TBASI - 20:
-        x = -7.90298 * (TBASW / temperature_kelvin - 1.0) + 5.02808 * np.log10(TBASW / temperature_kelvin) \
-            - 1.3816e-07 * (10.0 ** ((1.0 - temperature_kelvin / TBASW) * 11.344) - 1.0) \
-            + 8.1328e-03 * (10.0 ** ((TBASW / temperature_kelvin - 1.0) * (-3.49149)) - 1.0) \
-            + np.log10(ESBASW)
-        esh2o = 10. ** x
+    es = gfssvp(temperature_celsius) * np.clip(relative_humidity / 100., 0, 1)
+    qs = EPS * es / (pressure_hpa * 100.0 - (1 - EPS) * es)
+    return qs * 1e6  # in mg/kg
 
-    if temperature_kelvin <= -20 + TBASI:
-        es = esice
-    elif temperature_kelvin >= TBASI:
-        es = esh2o
-    else:
-        es = 0.05 * ((TBASI - temperature_kelvin) * esice + (temperature_kelvin - TBASI + 20.) * esh2o)
-    return es
+
+# The US Standard Atmosphere up to 47 km, one row per layer: base altitude (m), base temperature (K),
+# lapse rate (K/m) and base pressure (hPa). Balloons float in the isothermal and warming layers above 11 km
+STANDARD_ATMOSPHERE_LAYERS = np.array([
+    [0., 288.15, -0.0065, 1013.25],
+    [11000., 216.65, 0., 226.3206],
+    [20000., 216.65, 0.001, 54.74889],
+    [32000., 228.65, 0.0028, 8.680187],
+])
+STANDARD_GRAVITY = 9.80665
+STANDARD_RDGAS = 287.053
+
+
+def standard_atmosphere_pressure(altitude):
+    """
+    Pressure (hPa) of the US Standard Atmosphere at each altitude (m), for whole arrays at once
+    Unlike ObservationErrorModel.estimate_pressure, this holds above the tropopause; NaN altitudes give NaN
+    """
+    altitude = np.asarray(altitude, dtype=float)
+    layer = np.clip(np.searchsorted(STANDARD_ATMOSPHERE_LAYERS[:, 0], altitude, side='right') - 1,
+                    0, len(STANDARD_ATMOSPHERE_LAYERS) - 1)
+    base_altitude, base_temperature, lapse_rate, base_pressure = STANDARD_ATMOSPHERE_LAYERS[layer].T
+    height = altitude - base_altitude
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        isothermal = base_pressure * np.exp(-STANDARD_GRAVITY * height / (STANDARD_RDGAS * base_temperature))
+        exponent = STANDARD_GRAVITY / (STANDARD_RDGAS * np.where(lapse_rate == 0, 1, lapse_rate))
+        lapsed = base_pressure * (base_temperature / (base_temperature + lapse_rate * height)) ** exponent
+    return np.where(lapse_rate == 0, isothermal, lapsed)
+
+
+"""
+In this section, we quality control observations before they are written, setting the prepbufr quality marks
+(PQM, ZQM, WQM, TQM and QQM) for a whole segment at once. Values that fail a gross error check are marked as
+rejected, and observations left with nothing usable, or with nowhere to put them, aren't written at all
+"""
+
+GOOD_MARK = 1.
+NEUTRAL_MARK = 2.
+REJECTED_MARK = 13.
+MISSING_MARK = 31.
+
+QualityMarks = collections.namedtuple('QualityMarks', ['pressure', 'altitude', 'wind', 'temperature', 'humidity',
+                                                       'usable'])
+
+
+class QualityControl:
+    """
+    Gross error checks, each of which can be loosened or tightened:
+    :param temperature_range: (min, max) plausible temperature (C)
+    :param max_relative_humidity: highest plausible relative humidity (%); a little over 100 allows for
+        supersaturation with respect to ice and sensor noise
+    :param max_wind_speed: highest plausible wind speed (m/s)
+    :param pressure_range: (min, max) plausible pressure (hPa)
+    :param max_pressure_altitude_mismatch: how far the pressure may be from the standard atmosphere pressure at
+        the altitude, as a difference in log pressure (0.25 is roughly 2 km), before both are rejected
+
+    Pressures and altitudes that follow the US Standard Atmosphere pass, from the surface up to 30 km:
+    >>> altitude = [0, 5000, 10000, 15000, 20000, 21000, 22000, 24000, 25000, 30000]
+    >>> pressure = [1013.25, 540.48, 264.36, 120.45, 54.75, 46.78, 39.99, 29.30, 25.11, 11.97]
+    >>> data = to_observations([{'mission_name': 'W-1', 'timestamp': 0, 'latitude': 0, 'longitude': 0,
+    ...                          'altitude': z, 'pressure': p} for z, p in zip(altitude, pressure)]).data
+    >>> marks = QualityControl().marks(data)
+    >>> bool(np.all(marks.pressure == GOOD_MARK) and np.all(marks.altitude == GOOD_MARK) and marks.usable.all())
+    True
+    """
+
+    def __init__(self, temperature_range=(-100., 60.), max_relative_humidity=110., max_wind_speed=150.,
+                 pressure_range=(1., 1100.), max_pressure_altitude_mismatch=0.25):
+        self.temperature_range = temperature_range
+        self.max_relative_humidity = max_relative_humidity
+        self.max_wind_speed = max_wind_speed
+        self.pressure_range = pressure_range
+        self.max_pressure_altitude_mismatch = max_pressure_altitude_mismatch
+
+    def marks(self, data, specific_humidity=None):
+        """
+        Quality marks for every observation in data
+        :param specific_humidity: the specific humidity that will be written, if already worked out
+        :return: QualityMarks of arrays, with a usable mask of the observations that are worth writing
+        """
+        if specific_humidity is None:
+            specific_humidity = relative_to_specific_humidity(data['temperature'], data['pressure'], data['humidity'])
+
+        pressure = data['pressure']
+        altitude = data['altitude']
+        temperature = data['temperature']
+        relative_humidity = data['humidity']
+        wind_speed = np.hypot(data['speed_u'], data['speed_v'])
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            bad_pressure = (pressure < self.pressure_range[0]) | (pressure > self.pressure_range[1])
+            mismatch = np.abs(np.log(pressure / standard_atmosphere_pressure(altitude)))
+            bad_pressure_altitude = mismatch > self.max_pressure_altitude_mismatch
+            bad_temperature = (temperature < self.temperature_range[0]) | (temperature > self.temperature_range[1])
+            bad_humidity = (relative_humidity < 0) | (relative_humidity > self.max_relative_humidity) | \
+                bad_temperature | bad_pressure
+            bad_wind = wind_speed > self.max_wind_speed
+
+        def marks(missing, bad, good=GOOD_MARK):
+            return np.where(missing, MISSING_MARK, np.where(bad, REJECTED_MARK, good))
+
+        pressure_marks = marks(np.isnan(pressure), bad_pressure | bad_pressure_altitude)
+        altitude_marks = marks(np.isnan(altitude), bad_pressure_altitude)
+        wind_marks = marks(np.isnan(data['speed_u']) | np.isnan(data['speed_v']), bad_wind)
+        temperature_marks = marks(np.isnan(temperature), bad_temperature)
+        humidity_marks = marks(np.isnan(specific_humidity), bad_humidity, NEUTRAL_MARK)
+
+        # an observation needs a place to go, and something worth assimilating once it's there
+        located = (np.abs(data['latitude']) <= 90) & (np.abs(data['longitude']) <= 360) & \
+            ((pressure_marks < REJECTED_MARK) | (altitude_marks < REJECTED_MARK))
+        usable = located & ((pressure_marks < REJECTED_MARK) | (wind_marks < REJECTED_MARK) |
+                            (temperature_marks < REJECTED_MARK) | (humidity_marks < REJECTED_MARK))
+
+        return QualityMarks(pressure_marks, altitude_marks, wind_marks, temperature_marks, humidity_marks, usable)
 
 
-def convert_to_prepbufr(data, reftime, output_file='export.prepbufr'):
+"""
+In this section, we thin dense stretches of observations before they are written, since the assimilation pays for
+every subset it reads and a balloon can put many near-identical super observations in one analysis box
+Observations are binned on a lat/lon/pressure-layer/time grid, and each bin is cut down to one observation
+"""
+
+
+class Thinning:
+    """
+    Thins observations to one per bin of degrees of latitude and longitude, layer_hpa of pressure and minutes of
+    time, either keeping the earliest observation in each bin or averaging the bin's observations together
+    A size of 0 or None leaves that dimension out of the binning. Pressure is estimated from altitude where it
+    is missing, and observations with no position are left as they are
+    Each mission is binned separately, so combined files never merge two balloons' observations into one
+    """
+
+    METHODS = ('first', 'mean')
+
+    def __init__(self, degrees=1.0, layer_hpa=25.0, minutes=60.0, method='first'):
+        if method not in self.METHODS:
+            raise ValueError(f"Unknown thinning method {method!r}; choose from {self.METHODS}")
+        self.degrees = degrees
+        self.layer_hpa = layer_hpa
+        self.minutes = minutes
+        self.method = method
+
+    def bin_keys(self, observations):
+        """
+        The bin of each observation, as a single integer made by packing together its bin number along each
+        dimension, so bins can be found with one np.unique
+        :return: the keys, and a mask of the observations that could be binned
+        """
+        pressure = observations['pressure']
+        pressure = np.where(np.isnan(pressure), ObservationErrorModel.estimate_pressure(observations['altitude']),
+                            pressure)
+        latitude = observations['latitude']
+        longitude = (observations['longitude'] + 180) % 360
+
+        dimensions = [observations['mission']]
+        if self.degrees:
+            dimensions += [(latitude + 90) / self.degrees, longitude / self.degrees]
+        if self.layer_hpa:
+            dimensions.append(pressure / self.layer_hpa)
+        if self.minutes:
+            dimensions.append(observations['timestamp'] / (self.minutes * 60))
+
+        valid = np.isfinite(latitude) & np.isfinite(longitude) & np.isfinite(pressure)
+        keys = np.zeros(int(valid.sum()), dtype=np.int64)
+        for dimension in dimensions:
+            bins = np.floor(dimension[valid]).astype(np.int64)
+            if len(bins) > 0:
+                bins -= bins.min()
+                keys = keys * (int(bins.max()) + 1) + bins
+        return keys, valid
+
+    def apply(self, observations):
+        """
+        :param observations: time-sorted observations
+        :return: the thinned observations, still in time order, and how many were removed
+        """
+        # with every size left out, each mission would be a single bin
+        if not (self.degrees or self.layer_hpa or self.minutes):
+            return observations, 0
+
+        keys, valid = self.bin_keys(observations)
+        binned = np.flatnonzero(valid)
+        _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        if len(first) == len(binned):
+            return observations, 0
+
+        thinned = observations.data[binned[first]].copy()
+        if self.method == 'mean':
+            counts = np.bincount(inverse)
+            timestamps = observations['timestamp'][binned]
+            thinned['timestamp'] = timestamps.min() + np.round(
+                np.bincount(inverse, weights=timestamps - timestamps.min()) / counts).astype(np.int64)
+            for field in OBSERVATION_FIELDS:
+                values = observations[field][binned]
+                present = ~np.isnan(values)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    thinned[field] = np.bincount(inverse, weights=np.where(present, values, 0)) / \
+                        np.bincount(inverse, weights=present)
+
+        # put each bin back where its first observation was, so observations at the same time keep their order
+        data = np.concatenate((thinned, observations.data[~valid]))
+        order = np.argsort(np.concatenate((binned[first], np.flatnonzero(~valid))), kind='stable')
+        result = Observations(data[order], observations.mission_names).sort_by_time()
+        return result, len(observations) - len(result)
+
+
+def station_id_floats(mission_names):
+    """
+    The SID for each mission name, which is the name packed into the 8 bytes of a float
+    """
+    return np.array([np.frombuffer(mission_name.ljust(8)[:8].encode(), dtype=np.float64)[0]
+                     for mission_name in mission_names])
+
+
+def prepbufr_values(data, error_model=None, quality_control=None):
+    """
+    Work out the values convert_to_prepbufr writes that aren't taken straight from the observations, for a whole
+    segment at once, leaving out the observations that quality control finds unusable
+    :return: the usable observations; a dict of specific_humidity, quality_marks, wind_error, temperature_error
+        and relative_humidity_error for them; and the number of observations left out
+    """
+    # convert from relative humidity to specific humidity for the whole segment up front
+    specific_humidity = relative_to_specific_humidity(data['temperature'], data['pressure'], data['humidity'])
+
+    # work out the quality marks for the whole segment, and drop what isn't worth encoding
+    quality_marks = (quality_control or QualityControl()).marks(data, specific_humidity)
+    rejected = int(np.sum(~quality_marks.usable))
+    if rejected > 0:
+        data = data[quality_marks.usable]
+        specific_humidity = specific_humidity[quality_marks.usable]
+        quality_marks = QualityMarks(*(marks[quality_marks.usable] for marks in quality_marks))
+
+    # Set the error values using the error tables, all at once
+    if error_model is None:
+        error_model = ObservationErrorModel.default()
+    wind_error, temperature_error, relative_humidity_error = error_model.errors(data['pressure'], data['altitude'])
+
+    return data, {
+        'specific_humidity': specific_humidity,
+        'quality_marks': quality_marks,
+        'wind_error': wind_error,
+        'temperature_error': temperature_error,
+        'relative_humidity_error': relative_humidity_error,
+    }, rejected
+
+
+def convert_to_prepbufr(data, reftime, output_file='export.prepbufr', subsets_per_message=2, error_model=None,
+                        index=True, table='prepbufr_config.table', quality_control=None):
+    """
+    Write observations to a prepbufr file, as a pair of ADPUPA subsets per observation:
+    one with pressure and winds (232) and one with temperature and humidity (132)
+    :param subsets_per_message: how many subsets to pack into each BUFR message before starting the next;
+        the default of 2 gives one observation per message. Bufrlib also starts a new message on its own
+        whenever the next subset wouldn't fit, so large values are safe
+    :param error_model: ObservationErrorModel to take observation errors from; defaults to the built-in tables
+    :param index: also write a sidecar index of the file's messages, for PrepbufrIndex to read
+    :param table: the BUFR (DX) table file to encode with
+    :param quality_control: QualityControl to set the quality marks with; observations it finds unusable are
+        left out of the file
+    :return: a dict with the number of messages and subsets written, and observations rejected
+    """
     if len(data) == 0:
         print("No data; skipping")
-        return
+        return {'messages': 0, 'subsets': 0, 'rejected': 0}
+
+    data, values, rejected = prepbufr_values(data, error_model, quality_control)
+    if rejected > 0:
+        print(f"Warning: Rejected {rejected} observation(s) with no usable position or values, skipping.")
+        if len(data) == 0:
+            print("No usable data; skipping")
+            return {'messages': 0, 'subsets': 0, 'rejected': rejected}
+    specific_humidity = values['specific_humidity']
+    quality_marks = values['quality_marks']
+    wind_error = values['wind_error']
+    temperature_error = values['temperature_error']
+    relative_humidity_error = values['relative_humidity_error']
+
+    import ncepbufr
 
-    bufr = ncepbufr.open(output_file, 'w', table='prepbufr_config.table')
+    bufr = ncepbufr.open(output_file, 'w', table=table)
 
     hdstr = 'SID XOB YOB DHR TYP ELV SAID T29 TSB'
     obstr = 'POB QOB TOB ZOB UOB VOB PWO MXGS HOVI CAT PRSS TDO PMO'
@@ -207,66 +1104,67 @@ def convert_to_prepbufr(data, reftime, output_file='export.prepbufr'):
     int_date = start_date.year * 1000000 + start_date.month * 10000 + start_date.day * 100 + start_date.hour
     subset = 'ADPUPA'
 
+    nlvl = 1
+
+    # these are filled in for each subset, so allocate them once and reset them for each observation
     hdr = bufr.missing_value * np.ones(len(hdstr.split()), float)
+    obs = bufr.missing_value * np.ones((len(obstr.split()), nlvl), float)
+    dr = bufr.missing_value * np.ones((len(drstr.split()), nlvl), float)
+    oer = bufr.missing_value * np.ones((len(oestr.split()), nlvl), float)
+    qcf = bufr.missing_value * np.ones((len(qcstr.split()), nlvl), float)
+
+    observations_per_message = max(1, subsets_per_message // 2)
+    messages = 0
+
+    timestamps = data['timestamp']
+    assert (np.diff(timestamps) >= 0).all()  # do not allow out of order data
+    delta_hours = (timestamps - reftime) / 3600.0
+    station_ids = station_id_floats(data.mission_names)[data['mission']]
+
+    longitude = data['longitude']
+    latitude = data['latitude']
+    altitude = data['altitude']
+    pressure = data['pressure']
+    temperature = data['temperature']
+    speed_u = data['speed_u']
+    speed_v = data['speed_v']
 
     for i in range(len(data)):
-        point = data[i]
-        delta_hours = (point['timestamp'] - data[0]['timestamp']) / 3600.0
-        delta_hours = (point['timestamp'] - reftime) / 3600.0
-
-        assert i == 0 or data[i - 1]['timestamp'] <= point['timestamp']  # do not allow out of order data
-
         hdr[:] = bufr.missing_value
 
-        hdr[0] = np.frombuffer(point['mission_name'].ljust(8)[:8].encode(), dtype=np.float64)[0]
-        hdr[1] = point['longitude']
-        hdr[2] = point['latitude']
-        hdr[3] = delta_hours
+        hdr[0] = station_ids[i]
+        hdr[1] = longitude[i]
+        hdr[2] = latitude[i]
+        hdr[3] = delta_hours[i]
         hdr[4] = 232
         hdr[8] = 1
 
-        bufr.open_message(subset, int_date)
-
-        nlvl = 1
+        if i % observations_per_message == 0:
+            bufr.open_message(subset, int_date)
+            messages += 1
 
-        obs = bufr.missing_value * np.ones((len(obstr.split()), nlvl), float)
-        dr = bufr.missing_value * np.ones((len(drstr.split()), nlvl), float)
+        obs[:] = bufr.missing_value
+        dr[:] = bufr.missing_value
         dr[0] = hdr[1]
         dr[1] = hdr[2]
         dr[2] = hdr[3]
-        oer = bufr.missing_value * np.ones((len(oestr.split()), nlvl), float)
-        qcf = bufr.missing_value * np.ones((len(qcstr.split()), nlvl), float)
+        oer[:] = bufr.missing_value
+        qcf[:] = bufr.missing_value
 
-        if point['pressure'] is None:
-            qcf[0, 0] = 31.
-        else:
-            obs[0, 0] = point['pressure']
-            qcf[0, 0] = 1.
-
-        obs[3, 0] = point['altitude']
-        obs[4, 0] = point['speed_u']
-        obs[5, 0] = point['speed_v']
-        qcf[4, 0] = 1.
-        qcf[3, 0] = 1.
-        qcf[1, 0] = 31.
-        qcf[2, 0] = 31.
-
-        # Set the error values using the input table data that is above.
-        if point["pressure"] == None:
-            # Just a quick estimate, close enough for error characteristics
-            if (point["altitude"] == None):
-                print("Warning: Found some data with no pressure or altitude, skipping.")
-            interp_pressure = 3.83325e-22 * (44330.7 - point["altitude"])**5.255799
-        else:
-            interp_pressure = point["pressure"]
-        wind_speed_error = np.interp(interp_pressure, error_winds["pressure"], error_winds["speed"])
-        wind_x_error = wind_speed_error
-        wind_y_error = wind_speed_error
-        relative_humidity_error = np.interp(interp_pressure, error_thermo["pressure"], error_thermo["rh"])
-        temperature_error = np.interp(interp_pressure, error_thermo["pressure"], error_thermo["temp"])
+        if not np.isnan(pressure[i]):
+            obs[0, 0] = pressure[i]
+        qcf[0, 0] = quality_marks.pressure[i]
+
+        obs[3, 0] = altitude[i]
+        obs[4, 0] = speed_u[i]
+        obs[5, 0] = speed_v[i]
+        qcf[4, 0] = quality_marks.wind[i]
+        qcf[3, 0] = quality_marks.altitude[i]
+        qcf[1, 0] = MISSING_MARK
+        qcf[2, 0] = MISSING_MARK
 
         oer[3, 0] = 4
-        oer[4, 0] = max(wind_x_error, wind_y_error)
+        oer[4, 0] = wind_error[i]
 
         bufr.write_subset(hdr, hdstr)
         bufr.write_subset(obs, obstr)
@@ -280,36 +1178,19 @@ def convert_to_prepbufr(data, reftime, output_file='export.prepbufr'):
         hdr[8] = 1
         obs[4:, 0] = bufr.missing_value
         qcf[4:, 0] = bufr.missing_value
-        qcf[4, 0] = 31.
+        qcf[4, 0] = MISSING_MARK
         oer[:, 0] = bufr.missing_value
         oer[3, 0] = 4
 
-        # convert from relative humidity to specific humidity
-        specific_humidity = None
-        if point['temperature'] is not None and point['pressure'] is not None and point['humidity'] is not None:
-            #point = {'altitude': 6791.21, 'humidity': 97.5297606332122, 'latitude': 55.37090461538461, 'longitude': 16.212832884615384, 'mission_name': 'W-696', 'pressure': 422.91500495374595, 'speed_x': 8.41, 'speed_y': 9.98, 'temperature': -24.819797888992383, 'timestamp': 1691082605}
-
-            es = gfssvp(point['temperature']) * min(1, max(0, point['humidity'] / 100.))
-            qs = EPS * es / (point['pressure'] * 100.0 - (1 - EPS) * es)
-            newspec = qs
-
-            spec = newspec
-
-            specific_humidity = spec * 1e6  # in mg/kg
-
-        if specific_humidity is not None:
-            obs[1, 0] = specific_humidity
-            oer[1, 0] = relative_humidity_error * 0.7
-            qcf[1, 0] = 2.
-        else:
-            qcf[1, 0] = 31.
+        if not np.isnan(specific_humidity[i]):
+            obs[1, 0] = specific_humidity[i]
+            oer[1, 0] = relative_humidity_error[i] * 0.7
+        qcf[1, 0] = quality_marks.humidity[i]
 
-        if point['temperature'] is not None:
-            obs[2, 0] = point['temperature']
-            oer[2, 0] = temperature_error
-            qcf[2, 0] = 1.
-        else:
-            qcf[2, 0] = 31.
+        if not np.isnan(temperature[i]):
+            obs[2, 0] = temperature[i]
+            oer[2, 0] = temperature_error[i]
+        qcf[2, 0] = quality_marks.temperature[i]
 
         bufr.write_subset(hdr, hdstr)
         bufr.write_subset(obs, obstr)
@@ -317,135 +1198,1269 @@ def convert_to_prepbufr(data, reftime, output_file='export.prepbufr'):
         bufr.write_subset(oer, oestr)
         bufr.write_subset(qcf, qcstr, end=True)
 
-        bufr.close_message()
+        if (i + 1) % observations_per_message == 0 or i == len(data) - 1:
+            bufr.close_message()
+
+    bufr.close()
+    if index:
+        write_prepbufr_index(output_file, data, reftime)
+    return {'messages': messages, 'subsets': 2 * len(data), 'rejected': rejected}
+
+
+"""
+In this section, we index the prepbufr files we write, so that tools which only want some of the observations
+in a file can read just the messages holding them rather than decoding the whole file
+The index sits next to the file as <file>.idx.json, and records where each message is in the file along with
+the stations, time range (DHR, hours from the file's reference time) and lat/lon bounds of what's in it
+"""
+
+PREPBUFR_INDEX_VERSION = 1
+BUFR_TABLE_CATEGORY = 11
+
+
+def prepbufr_index_file(prepbufr_file):
+    return prepbufr_file + '.idx.json'
 
+
+def scan_bufr_messages(path):
+    """
+    Find the BUFR messages in a file from their section headers, without decoding them
+    Anything between messages, such as Fortran record markers, is skipped over
+    :return: a list of (byte offset, length, data category, number of subsets) for each message
+    """
+    with open(path, 'rb') as f:
+        contents = f.read()
+
+    messages = []
+    offset = contents.find(b'BUFR')
+    while offset >= 0 and offset + 8 <= len(contents):
+        length = int.from_bytes(contents[offset + 4:offset + 7], 'big')
+        edition = contents[offset + 7]
+        section1 = offset + 8
+        section1_length = int.from_bytes(contents[section1:section1 + 3], 'big')
+        if edition >= 4:
+            has_section2 = contents[section1 + 9] & 0x80
+            category = contents[section1 + 10]
+        else:
+            has_section2 = contents[section1 + 7] & 0x80
+            category = contents[section1 + 8]
+
+        section3 = section1 + section1_length
+        if has_section2:
+            section3 += int.from_bytes(contents[section3:section3 + 3], 'big')
+        subsets = int.from_bytes(contents[section3 + 4:section3 + 6], 'big')
+
+        messages.append((offset, length, category, subsets))
+        offset = contents.find(b'BUFR', offset + length)
+    return messages
+
+
+def write_prepbufr_index(output_file, data, reftime):
+    """
+    Write the sidecar index for a prepbufr file written by convert_to_prepbufr from data
+    Observations are two subsets each, in order, so the subset counts in the message headers say which
+    observations each message holds, even where bufrlib started a new message on its own
+    """
+    messages = scan_bufr_messages(output_file)
+    tables = [message for message in messages if message[2] == BUFR_TABLE_CATEGORY]
+    messages = [message for message in messages if message[2] != BUFR_TABLE_CATEGORY]
+
+    subsets = np.array([message[3] for message in messages], dtype=np.int64)
+    if subsets.sum() != 2 * len(data):
+        print(f"Warning: found {subsets.sum()} subset(s) in {output_file} but wrote {2 * len(data)}; "
+              f"not indexing it")
+        return
+
+    # each message holds the observations from its first subset up to its last, which may be shared with the
+    # message before or after it if bufrlib split an observation's pair of subsets between them
+    first_subset = np.concatenate(([0], np.cumsum(subsets)[:-1]))
+    first = first_subset // 2
+    last = (first_subset + subsets - 1) // 2
+
+    def bounds(values):
+        low = np.fmin.reduceat(values, first)
+        high = np.fmax.reduceat(values, first)
+        # reduceat stops each message at the next message's first observation, so take in any shared one
+        shared = last > first
+        shared[:-1] &= last[:-1] == first[1:]
+        low[shared] = np.fmin(low[shared], values[last[shared]])
+        high[shared] = np.fmax(high[shared], values[last[shared]])
+        return [[None if np.isnan(a) else float(a), None if np.isnan(b) else float(b)] for a, b in zip(low, high)]
+
+    delta_hours = (data['timestamp'] - reftime) / 3600.0
+    codes = data['mission']
+    message_missions = [sorted({data.mission_names[code] for code in np.unique(codes[start:end + 1])})
+                        for start, end in zip(first, last)] if len(np.unique(codes)) > 1 else \
+        [[data.mission_names[codes[0]]]] * len(messages)
+
+    index = {
+        'version': PREPBUFR_INDEX_VERSION,
+        'file': os.path.basename(output_file),
+        'reftime': int(reftime),
+        'tables': [[offset, length] for offset, length, _, _ in tables],
+        'messages': [
+            {'offset': offset, 'length': length, 'subsets': count, 'sid': sid, 'dhr': dhr, 'lat': lat, 'lon': lon}
+            for (offset, length, _, count), sid, dhr, lat, lon in zip(
+                messages, message_missions, bounds(delta_hours), bounds(data['latitude']), bounds(data['longitude']))
+        ],
+    }
+    with open(prepbufr_index_file(output_file) + '.tmp', 'w') as f:
+        json.dump(index, f, separators=(',', ':'))
+    os.replace(prepbufr_index_file(output_file) + '.tmp', prepbufr_index_file(output_file))
+
+
+class PrepbufrIndex:
+    """
+    Reads the sidecar index of a prepbufr file, to pull out only the messages for some missions, times or area
+    For example, to copy one hour of W-1594's observations into a file that ncepbufr can open on its own:
+        PrepbufrIndex('WindBorne_all_2024-04-29_00:00_6h.prepbufr').extract(
+            'W-1594.prepbufr', mission_name='W-1594', start_time=1714348800, end_time=1714352400)
+    """
+
+    def __init__(self, prepbufr_file):
+        self.prepbufr_file = prepbufr_file
+        with open(prepbufr_index_file(prepbufr_file)) as f:
+            index = json.load(f)
+        if index.get('version') != PREPBUFR_INDEX_VERSION:
+            raise ValueError(f"{prepbufr_index_file(prepbufr_file)} is not an index this version can read")
+        self.reftime = index['reftime']
+        self.tables = index['tables']
+        self.messages = index['messages']
+
+    def select(self, mission_name=None, start_time=None, end_time=None, latitude=None, longitude=None):
+        """
+        The index entries of the messages that may hold matching observations
+        :param start_time: unix time; with end_time, messages are kept if their observations overlap the range
+        :param latitude: (min, max) in degrees; longitude likewise
+        """
+        def overlaps(bounds, low, high):
+            if bounds[0] is None:
+                return False
+            return (low is None or bounds[1] >= low) and (high is None or bounds[0] <= high)
+
+        start_hours = None if start_time is None else (start_time - self.reftime) / 3600.0
+        end_hours = None if end_time is None else (end_time - self.reftime) / 3600.0
+        return [message for message in self.messages
+                if (mission_name is None or mission_name in message['sid'])
+                and (start_hours is None and end_hours is None or overlaps(message['dhr'], start_hours, end_hours))
+                and (latitude is None or overlaps(message['lat'], *latitude))
+                and (longitude is None or overlaps(message['lon'], *longitude))]
+
+    def read_messages(self, **filters):
+        """
+        The raw bytes of each message that may hold matching observations; takes the same filters as select
+        """
+        with open(self.prepbufr_file, 'rb') as f:
+            return [self._read(f, message['offset'], message['length']) for message in self.select(**filters)]
+
+    def extract(self, output_file, **filters):
+        """
+        Copy the file's tables and the messages that may hold matching observations into a new prepbufr file
+        :return: the number of messages copied
+        """
+        with open(self.prepbufr_file, 'rb') as f, open(output_file, 'wb') as out:
+            for offset, length in self.tables:
+                out.write(self._read(f, offset, length))
+            selected = self.select(**filters)
+            for message in selected:
+                out.write(self._read(f, message['offset'], message['length']))
+        return len(selected)
+
+    @staticmethod
+    def _read(f, offset, length):
+        f.seek(offset)
+        return f.read(length)
+
+
+"""
+In this section, we read prepbufr files back and check them against the observations they were written from
+Each subset is read with two calls into bufrlib, one for the header and one for the observation values, into
+columns that are then compared for the whole file at once
+"""
+
+VERIFY_HEADER = 'SID XOB YOB DHR TYP'
+VERIFY_VALUES = 'POB QOB TOB ZOB UOB VOB PQM QQM TQM ZQM WQM QOE TOE WOE'
+
+# the mnemonics checked in each of the pair of subsets written for an observation
+VERIFY_232 = ['XOB', 'YOB', 'DHR', 'POB', 'ZOB', 'UOB', 'VOB', 'PQM', 'ZQM', 'WQM', 'WOE']
+VERIFY_132 = ['XOB', 'YOB', 'DHR', 'POB', 'QOB', 'TOB', 'PQM', 'QQM', 'TQM', 'QOE', 'TOE']
+
+
+def bufr_table_scales(table='prepbufr_config.table'):
+    """
+    The decimal scale of each numeric mnemonic in a BUFR (DX) table; values are stored to within half of
+    10 ** -scale
+    """
+    scales = {}
+    with open(table) as f:
+        for line in f:
+            fields = [field.strip() for field in line.split('|')]
+            if len(fields) > 5 and fields[2].lstrip('-').isdigit() and fields[3].lstrip('-').isdigit():
+                scales[fields[1]] = int(fields[2])
+    return scales
+
+
+def read_prepbufr(prepbufr_file):
+    """
+    Read every subset of a prepbufr file into columns
+    :return: a dict of mnemonic -> array with one entry per subset, with missing values as NaN and SID as strings
+    """
+    import ncepbufr
+
+    header_rows = []
+    value_rows = []
+    bufr = ncepbufr.open(prepbufr_file)
+    while bufr.advance() == 0:
+        while bufr.load_subset() == 0:
+            header_rows.append(np.ma.filled(bufr.read_subset(VERIFY_HEADER), np.nan)[:, 0])
+            value_rows.append(np.ma.filled(bufr.read_subset(VERIFY_VALUES), np.nan)[:, 0])
     bufr.close()
 
-def convert_to_netcdf(data, curtime, bucket_hours ):
-    # This module outputs data in netcdf format for the WMO ISARRA program.  The output format is netcdf
-    #   and the style (variable names, file names, etc.) are described here:
-    #  https://github.com/synoptic/wmo-uasdc/tree/main/raw_uas_to_netCDF
-
-    # Mapping of WindBorne names to ISARRA names
-    rename_dict = {
-        'latitude' : 'lat',
-        'longitude' : 'lon',
-        'altitude' : 'altitude',
-        'temperature' : 'air_temperature',
-        'wind_direction' : 'wind_direction',
-        'wind_speed' : 'wind_speed',
-        'pressure' : 'air_pressure',
-        'humidity_mixing_ratio' : 'humidity_mixing_ratio',
-        'index' : 'obs',
+    header = np.array(header_rows, dtype=float).reshape(-1, len(VERIFY_HEADER.split()))
+    values = np.array(value_rows, dtype=float).reshape(-1, len(VERIFY_VALUES.split()))
+    columns = dict(zip(VERIFY_HEADER.split(), header.T))
+    columns.update(zip(VERIFY_VALUES.split(), values.T))
+    columns['SID'] = np.char.strip(np.char.decode(np.ascontiguousarray(columns['SID']).view('S8'), errors='replace'))
+    return columns
+
+
+def expected_prepbufr(data, reftime, error_model=None, quality_control=None):
+    """
+    The columns convert_to_prepbufr should have written for data, in the same shape read_prepbufr returns
+    """
+    data, values, _ = prepbufr_values(data, error_model, quality_control)
+    marks = values['quality_marks']
+    specific_humidity = values['specific_humidity']
+    temperature = data['temperature']
+
+    def pairs(wind_subset, thermo_subset):
+        column = np.empty(2 * len(data))
+        column[0::2] = wind_subset
+        column[1::2] = thermo_subset
+        return column
+
+    nan = np.full(len(data), np.nan)
+    delta_hours = (data['timestamp'] - reftime) / 3600.0
+    return {
+        'SID': np.repeat([data.mission_names[code].ljust(8)[:8].strip() for code in data['mission']], 2),
+        'XOB': np.repeat(data['longitude'], 2),
+        'YOB': np.repeat(data['latitude'], 2),
+        'DHR': np.repeat(delta_hours, 2),
+        'TYP': pairs(232, 132),
+        'POB': np.repeat(data['pressure'], 2),
+        'QOB': pairs(nan, specific_humidity),
+        'TOB': pairs(nan, temperature),
+        'ZOB': np.repeat(data['altitude'], 2),
+        'UOB': pairs(data['speed_u'], nan),
+        'VOB': pairs(data['speed_v'], nan),
+        'PQM': np.repeat(marks.pressure, 2),
+        'QQM': pairs(MISSING_MARK, marks.humidity),
+        'TQM': pairs(MISSING_MARK, marks.temperature),
+        'ZQM': np.repeat(marks.altitude, 2),
+        'WQM': pairs(marks.wind, MISSING_MARK),
+        'QOE': pairs(nan, np.where(np.isnan(specific_humidity), np.nan, values['relative_humidity_error'] * 0.7)),
+        'TOE': pairs(nan, np.where(np.isnan(temperature), np.nan, values['temperature_error'])),
+        'WOE': pairs(values['wind_error'], nan),
     }
 
-    # Put the data in a panda datafram in order to easily push to xarray then netcdf output
-    df = pd.DataFrame(data)
-    ds = xr.Dataset.from_dataframe(df)
 
-    # Build the filename and save some variables for use later
+def verify_prepbufr(prepbufr_file, data, reftime, error_model=None, quality_control=None,
+                    table='prepbufr_config.table'):
+    """
+    Read back a file written by convert_to_prepbufr and check it against the observations it was written from,
+    with the same error model and quality control. Values must match to within the precision the table stores
+    them at, and be missing in the same places
+    :return: a dict of the subsets checked, the number of mismatched values for each mnemonic that had any,
+        and how long reading and checking took
+    """
+    start = time.perf_counter()
+    read = read_prepbufr(prepbufr_file)
+    read_seconds = time.perf_counter() - start
+
+    expected = expected_prepbufr(data, reftime, error_model, quality_control)
+    if len(read['TYP']) != len(expected['TYP']):
+        return {
+            'subsets_verified': len(read['TYP']),
+            'mismatches': {'subsets': abs(len(read['TYP']) - len(expected['TYP']))},
+            'read_seconds': read_seconds,
+            'seconds': time.perf_counter() - start,
+        }
+
+    scales = bufr_table_scales(table)
+    mismatches = collections.Counter()
+    mismatches['SID'] = int(np.sum(read['SID'] != expected['SID']))
+    mismatches['TYP'] = int(np.sum(read['TYP'] != expected['TYP']))
+    for typ, mnemonics in ((232, VERIFY_232), (132, VERIFY_132)):
+        subsets = expected['TYP'] == typ
+        for mnemonic in mnemonics:
+            got = read[mnemonic][subsets]
+            want = expected[mnemonic][subsets]
+            if mnemonic == 'XOB':
+                # longitudes may come back as 0-360 or -180-180
+                got = (got + 180) % 360 - 180
+                want = (want + 180) % 360 - 180
+            tolerance = 0.5001 * 10.0 ** -scales.get(mnemonic, 0)
+            with np.errstate(invalid='ignore'):
+                wrong = (np.isnan(got) != np.isnan(want)) | (np.abs(got - want) > tolerance)
+            mismatches[mnemonic] += int(np.sum(wrong))
+
+    return {
+        'subsets_verified': len(read['TYP']),
+        'mismatches': {mnemonic: count for mnemonic, count in mismatches.items() if count > 0},
+        'read_seconds': read_seconds,
+        'seconds': time.perf_counter() - start,
+    }
+
+
+def isarra_output_file(mission_name, curtime, bucket_hours):
+    """
+    The ISARRA netcdf file name for a bucket, which contains the time at the start of the bucket
+    """
     mt = datetime.datetime.fromtimestamp(curtime, tz=datetime.timezone.utc)
     outdatestring = mt.strftime('%Y%m%d%H%M%S')
-    mission_name = ds['mission_name'].data[0]
-    output_file = 'USADC_300_0{}_{}Z.nc'.format(mission_name[2:6],outdatestring)
+    return 'USADC_300_0{}_{}Z.nc'.format(mission_name[2:6],outdatestring)
+
 
-    # Derived quantities calculated here:
+"""
+The ISARRA variables, in the order they are written, with the attributes for each
+"""
+ISARRA_VARIABLES = {
+    'lat': {'units': 'degrees_north', 'long_name': 'Latitude'},
+    'lon': {'units': 'degrees_east', 'long_name': 'Longitude'},
+    'altitude': {'units': 'meters_above_sea_level', 'long_name': 'Altitude'},
+    'air_pressure': {'units': 'Pa', 'long_name': 'Atmospheric Pressure'},
+    'air_temperature': {'units': 'Kelvin', 'long_name': 'Air Temperature'},
+    'humidity_mixing_ratio': {'units': 'kg/kg', 'long_name': 'Humidity Mixing Ratio'},
+    'wind_speed': {'units': 'm/s', 'long_name': 'Wind Speed'},
+    'wind_direction': {'units': 'degrees', 'long_name': 'Wind Direction'},
+}
+
+
+def isarra_columns(data):
+    """
+    Compute the ISARRA variables straight from the observation columns
+    """
 
     # convert from specific humidity to humidity_mixing_ratio
     mg_to_kg = 1000000.
-    if not all(x is None for x in ds['specific_humidity'].data):
-        ds['humidity_mixing_ratio'] = (ds['specific_humidity'] / mg_to_kg) / (1 - (ds['specific_humidity'] / mg_to_kg))
-    else:
-        ds['humidity_mixing_ratio'] = ds['specific_humidity']
+    specific_humidity = data['specific_humidity'] / mg_to_kg
 
     # Wind speed and direction from components
-    ds['wind_speed'] = np.sqrt(ds['speed_u']*ds['speed_u'] + ds['speed_v']*ds['speed_v'])
-    ds['wind_direction'] = np.mod(180 + (180 / np.pi) * np.arctan2(ds['speed_u'], ds['speed_v']), 360)
-
-    ds['time'] = ds['timestamp'].astype(float)
-    ds = ds.assign_coords(time=("time", ds['time'].data))
-
-    # Now that calculations are done, remove variables not needed in the netcdf output
-    ds = ds.drop_vars(['humidity', 'speed_u', 'speed_v', 'speed_x', 'speed_y', 'specific_humidity',
-                       'timestamp', 'mission_name'])
-
-    # Rename the variables
-    ds = ds.rename(rename_dict)
-
-    # Adding attributes to variables in the xarray dataset
-    ds['time'].attrs = {'units': 'seconds since 1970-01-01T00:00:00', 'long_name': 'Time', '_FillValue': float('nan'),
-                        'processing_level': ''}
-    ds['lat'].attrs = {'units': 'degrees_north', 'long_name': 'Latitude', '_FillValue': float('nan'),
-                       'processing_level': ''}
-    ds['lon'].attrs = {'units': 'degrees_east', 'long_name': 'Longitude', '_FillValue': float('nan'),
-                       'processing_level': ''}
-    ds['altitude'].attrs = {'units': 'meters_above_sea_level', 'long_name': 'Altitude', '_FillValue': float('nan'),
-                            'processing_level': ''}
-    ds['air_temperature'].attrs = {'units': 'Kelvin', 'long_name': 'Air Temperature', '_FillValue': float('nan'),
-                                   'processing_level': ''}
-    ds['wind_speed'].attrs = {'units': 'm/s', 'long_name': 'Wind Speed', '_FillValue': float('nan'),
-                              'processing_level': ''}
-    ds['wind_direction'].attrs = {'units': 'degrees', 'long_name': 'Wind Direction', '_FillValue': float('nan'),
-                                  'processing_level': ''}
-    ds['humidity_mixing_ratio'].attrs = {'units': 'kg/kg', 'long_name': 'Humidity Mixing Ratio',
-                                         '_FillValue': float('nan'), 'processing_level': ''}
-    ds['air_pressure'].attrs = {'units': 'Pa', 'long_name': 'Atmospheric Pressure', '_FillValue': float('nan'),
-                                'processing_level': ''}
-
-    # Add Global Attributes synonymous across all UASDC providers
-    ds.attrs['Conventions'] = "CF-1.8, WMO-CF-1.0"
-    ds.attrs['wmo__cf_profile'] = "FM 303-2024"
-    ds.attrs['featureType'] = "trajectory"
-
-    # Add Global Attributes unique to Provider
-    ds.attrs['platform_name'] = "WindBorne Global Sounding Balloon"
-    ds.attrs['flight_id'] = mission_name
-    ds.attrs['site_terrain_elevation_height'] = 'not applicable'
-    ds.attrs['processing_level'] = "b1"
-    ds.to_netcdf(output_file)
-
-def output_data(accumulated_observations, mission_name, starttime, bucket_hours, netcdf_output=False):
-    accumulated_observations.sort(key=lambda x: x['timestamp'])
+    speed_u = data['speed_u']
+    speed_v = data['speed_v']
+
+    return {
+        'lat': data['latitude'],
+        'lon': data['longitude'],
+        'altitude': data['altitude'],
+        'air_pressure': data['pressure'],
+        'air_temperature': data['temperature'],
+        'humidity_mixing_ratio': specific_humidity / (1 - specific_humidity),
+        'wind_speed': np.sqrt(speed_u*speed_u + speed_v*speed_v),
+        'wind_direction': np.mod(180 + (180 / np.pi) * np.arctan2(speed_u, speed_v), 360),
+    }
+
+
+def convert_to_netcdf(data, curtime, bucket_hours, append=False, complevel=4, chunk_size=1024, output_file=None):
+    """
+    This module outputs data in netcdf format for the WMO ISARRA program.  The output format is netcdf
+      and the style (variable names, file names, etc.) are described here:
+     https://github.com/synoptic/wmo-uasdc/tree/main/raw_uas_to_netCDF
+
+    Variables are written compressed in chunks of chunk_size observations. Buckets smaller than one chunk are
+    written uncompressed instead, as for those the chunk index takes more space than compression saves
+    :param append: if the file already exists, add only the observations whose times aren't in it yet,
+        rather than rewriting it. New files are always written chunked along unlimited dimensions so they can be
+        appended to later
+    :param complevel: zlib compression level, or 0 to write uncompressed
+    :param output_file: where to write; defaults to the ISARRA file name for the bucket
+    """
+
+    import netCDF4
+
+    # Build the filename and save some variables for use later
+    mission_name = data.mission_name(0)
+    if output_file is None:
+        output_file = isarra_output_file(mission_name, curtime, bucket_hours)
+
+    times = data['timestamp'].astype(float)
+    columns = isarra_columns(data)
+
+    if append and os.path.exists(output_file):
+        ds = netCDF4.Dataset(output_file, 'a')
+        if ds.flight_id != mission_name or not ds.dimensions['obs'].isunlimited():
+            flight_id = ds.flight_id
+            ds.close()
+            raise ValueError(f"Can't append {mission_name} observations to {output_file}, which is for "
+                             f"{flight_id} or wasn't written to be appended to")
+        start = len(ds.dimensions['obs'])
+        new = ~np.isin(times, ds['time'][:])
+        times = times[new]
+        columns = {name: values[new] for name, values in columns.items()}
+        print(f"Appending {len(times)} new observation(s) to {output_file}")
+    else:
+        ds = netCDF4.Dataset(output_file, 'w', format='NETCDF4')
+        start = 0
+
+        if append or len(times) >= chunk_size:
+            compress = complevel > 0
+            encoding = {'zlib': compress, 'complevel': complevel, 'shuffle': compress, 'chunksizes': (chunk_size,)}
+        else:
+            encoding = {'contiguous': True}
+        size = None if append else len(times)
+        ds.createDimension('obs', size)
+        ds.createDimension('time', size)
+        for name, attrs in ISARRA_VARIABLES.items():
+            variable = ds.createVariable(name, 'f8', ('obs',), fill_value=float('nan'), **encoding)
+            variable.setncatts({**attrs, 'processing_level': ''})
+        ds.createVariable('obs', 'i8', ('obs',), **encoding)
+        variable = ds.createVariable('time', 'f8', ('time',), fill_value=float('nan'), **encoding)
+        variable.setncatts({'units': 'seconds since 1970-01-01T00:00:00', 'long_name': 'Time', 'processing_level': ''})
+
+        # Add Global Attributes synonymous across all UASDC providers
+        ds.Conventions = "CF-1.8, WMO-CF-1.0"
+        ds.wmo__cf_profile = "FM 303-2024"
+        ds.featureType = "trajectory"
+
+        # Add Global Attributes unique to Provider
+        ds.platform_name = "WindBorne Global Sounding Balloon"
+        ds.flight_id = mission_name
+        ds.site_terrain_elevation_height = 'not applicable'
+        ds.processing_level = "b1"
+
+    end = start + len(times)
+    for name, values in columns.items():
+        ds[name][start:end] = values
+    ds['obs'][start:end] = np.arange(start, end)
+    ds['time'][start:end] = times
+    ds.close()
+
+def bucket_segments(timestamps, bucket_hours):
+    """
+    Split time-sorted timestamps into buckets of bucket_hours
+    :return: a list of (bucket start time, start index, end index) for each bucket that has data
+    """
 
     # Here, set the earliest time of data to be the first observation time, then set it to the most recent
     #    start of a bucket increment.
     # The reason to do this rather than using the input starttime, is because sometimes the data
     #    doesn't start at the start time, and the underlying output would try to output data that doesn't exist
     #
-    accumulated_observations.sort(key=lambda x: x['timestamp'])
-    earliest_time = accumulated_observations[0]['timestamp']
-    if (earliest_time < starttime):
-        print("WTF, how can we have gotten data from before the starttime?")
+    earliest_time = timestamps[0]
     curtime = earliest_time - earliest_time % (bucket_hours * 60 * 60)
 
+    segments = []
     start_index = 0
-    for i in range(len(accumulated_observations)):
-        if accumulated_observations[i]['timestamp'] - curtime > bucket_hours * 60 * 60:
-            segment = accumulated_observations[start_index:i]
-            mt = datetime.datetime.fromtimestamp(curtime, tz=datetime.timezone.utc)+datetime.timedelta(hours=bucket_hours/2)
-            output_file = (f"WindBorne_%s_%04d-%02d-%02d_%02d:00_%dh.prepbufr" %
-                           (mission_name, mt.year, mt.month, mt.day, mt.hour, bucket_hours))
-            if (netcdf_output):
-                print(f"Converting {len(segment)} observation(s) and saving as netcdf")
-                convert_to_netcdf(segment, curtime, bucket_hours)
-            else:
-                print(f"Converting {len(segment)} observation(s) to prepbufr and saving as {output_file}")
-                convert_to_prepbufr(segment, curtime + datetime.timedelta(hours=bucket_hours/2).seconds, output_file)
-
-            start_index = i
-            curtime += datetime.timedelta(hours=bucket_hours).seconds
+    while True:
+        # the next bucket starts at the first observation past the end of this one
+        # (the observation that opens a bucket is never itself compared against the following one)
+        end_index = max(int(np.searchsorted(timestamps, curtime + bucket_hours * 60 * 60, side='right')),
+                        start_index + 1)
+        if end_index >= len(timestamps):
+            break
+
+        segments.append((curtime, start_index, end_index))
+        start_index = end_index
+        curtime += datetime.timedelta(hours=bucket_hours).seconds
 
     # Cover any extra data within the latest partial bucket
-    segment = accumulated_observations[start_index:]
-    mt = datetime.datetime.fromtimestamp(curtime, tz=datetime.timezone.utc) + datetime.timedelta(hours=bucket_hours / 2)
-    output_file = (f"WindBorne_%s_%04d-%02d-%02d_%02d:00_%dh.prepbufr" %
-                   (mission_name, mt.year, mt.month, mt.day, mt.hour, bucket_hours))
-    if (netcdf_output):
-        print(f"Converting {len(segment)} observation(s) and saving as netcdf")
-        convert_to_netcdf(segment, curtime, bucket_hours)
+    segments.append((curtime, start_index, len(timestamps)))
+    return segments
+
+
+def bucket_output_file(mission_name, curtime, bucket_hours):
+    """
+    The prepbufr file name for a bucket, which contains the time at the mid-point of the bucket
+    """
+    mt = datetime.datetime.fromtimestamp(curtime, tz=datetime.timezone.utc)+datetime.timedelta(hours=bucket_hours/2)
+    return (f"WindBorne_%s_%04d-%02d-%02d_%02d:00_%dh.prepbufr" %
+            (mission_name, mt.year, mt.month, mt.day, mt.hour, bucket_hours))
+
+
+"""
+Output formats are registered here by name. Each writer takes one bucket's worth of time-sorted observations,
+starting at curtime, and writes it to its own file; output_file gives the name of that file
+To add a format, register a function with the same arguments. Import any heavy dependencies inside the function,
+so they are only loaded when that format is used
+"""
+
+Writer = collections.namedtuple('Writer', ['write', 'output_file'])
+WRITERS = {}
+
+
+def register_writer(name, output_file):
+    def register(write):
+        WRITERS[name] = Writer(write, output_file)
+        return write
+    return register
+
+
+@register_writer('prepbufr', bucket_output_file)
+def write_prepbufr(segment, mission_name, curtime, bucket_hours, output_file=None, verify=False, **options):
+    if output_file is None:
+        output_file = bucket_output_file(mission_name, curtime, bucket_hours)
+    print(f"Converting {len(segment)} observation(s) to prepbufr and saving as {output_file}")
+    reftime = curtime + datetime.timedelta(hours=bucket_hours/2).seconds
+    stats = convert_to_prepbufr(segment, reftime, output_file, **options)
+
+    if verify and stats['subsets'] > 0:
+        verification = verify_prepbufr(output_file, segment, reftime, options.get('error_model'),
+                                       options.get('quality_control'), options.get('table', 'prepbufr_config.table'))
+        if verification['mismatches']:
+            print(f"ERROR: {output_file} doesn't match the observations it was written from: "
+                  f"{verification['mismatches']}")
+        else:
+            print(f"Verified {verification['subsets_verified']} subset(s) in {output_file} "
+                  f"({verification['subsets_verified'] / verification['seconds']:.0f} subsets/s)")
+        stats['subsets_verified'] = verification['subsets_verified']
+        stats['verify_mismatches'] = sum(verification['mismatches'].values())
+        stats['verify_seconds'] = verification['seconds']
+    return stats
+
+
+@register_writer('netcdf', isarra_output_file)
+def write_netcdf(segment, mission_name, curtime, bucket_hours, **options):
+    print(f"Converting {len(segment)} observation(s) and saving as netcdf")
+    convert_to_netcdf(segment, curtime, bucket_hours, **options)
+
+
+def write_segment(segment, mission_name, curtime, bucket_hours, output_format='prepbufr', writer_options=None,
+                  output_dir=None):
+    """
+    Write one bucket's worth of time-sorted observations, starting at curtime, to its own file
+    :param writer_options: dict of extra keyword arguments for the writer
+    :param output_dir: directory to write the file in, rather than the current one
+    :return: a dict of stats about the write for RunReport.record_bucket, including any the writer returned
+    """
+    writer = WRITERS[output_format]
+    output_file = writer.output_file(mission_name, curtime, bucket_hours)
+    if output_dir is not None:
+        output_file = os.path.join(output_dir, output_file)
+
+    # thinning is set with the writer's options, but happens here, before any writer sees the observations
+    writer_options = dict(writer_options or {})
+    thinning = writer_options.pop('thinning', None)
+
+    start = time.perf_counter()
+    thinned = 0
+    if thinning is not None:
+        segment, thinned = thinning.apply(segment)
+        if thinned > 0:
+            print(f"Thinned out {thinned} of {len(segment) + thinned} observation(s)")
+    writer_stats = writer.write(segment, mission_name, curtime, bucket_hours, output_file=output_file,
+                                **writer_options)
+    return {
+        'output_file': output_file,
+        'observations': len(segment),
+        'thinned': thinned,
+        'seconds': time.perf_counter() - start,
+        'bytes': os.path.getsize(output_file) if os.path.exists(output_file) else 0,
+        **(writer_stats or {}),
+    }
+
+
+"""
+In this section, we keep a manifest of the files written to the output directory, so that re-running over an
+overlapping window only rewrites the buckets whose observations or writer settings have changed
+"""
+
+MANIFEST_FILE = 'wb_to_prepbufr_manifest.json'
+
+
+def _settings_value(value):
+    """
+    Turn writer options into something JSON can hash consistently, including objects like ObservationErrorModel
+    """
+    if isinstance(value, dict):
+        return {key: _settings_value(item) for key, item in sorted(value.items())}
+    if isinstance(value, (list, tuple)):
+        return [_settings_value(item) for item in value]
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if hasattr(value, '__dict__'):
+        return {'class': type(value).__name__, **_settings_value(vars(value))}
+    return value
+
+
+class OutputManifest:
+    """
+    Records, for each file written, a hash of the observations that went into it and of the settings it was
+    written with. A bucket whose hashes match its entry, and whose file is still there, doesn't need writing again
+    """
+
+    VERSION = 1
+
+    def __init__(self, path=MANIFEST_FILE):
+        self.path = path
+        self.entries = {}
+        self.seen = set()
+        self._pending = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                manifest = json.load(f)
+            if manifest.get('version') == self.VERSION:
+                self.entries = manifest['files']
+
+    @staticmethod
+    def input_hash(segment):
+        """
+        Hash the observations in a segment
+        Mission codes depend on the order missions were fetched in, so they are replaced by the mission names
+        """
+        codes, mission_index = np.unique(segment['mission'], return_inverse=True)
+        names = [segment.mission_names[code] for code in codes]
+
+        digest = hashlib.sha256()
+        digest.update('\0'.join(names).encode())
+        digest.update(np.ascontiguousarray(mission_index, dtype=np.int32).tobytes())
+        for name in OBSERVATION_DTYPE.names:
+            if name != 'mission':
+                digest.update(np.ascontiguousarray(segment[name]).tobytes())
+        return digest.hexdigest()
+
+    @classmethod
+    def settings_hash(cls, output_format, bucket_hours, writer_options):
+        settings = {'version': cls.VERSION, 'format': output_format, 'bucket_hours': bucket_hours,
+                    'options': _settings_value(writer_options or {})}
+        return hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+
+    def is_current(self, output_file, input_hash, settings_hash):
+        self.seen.add(output_file)
+        entry = self.entries.get(output_file)
+        return (entry is not None and entry['input_hash'] == input_hash and entry['settings_hash'] == settings_hash
+                and os.path.exists(output_file))
+
+    def expect(self, output_file, entry):
+        """
+        Note a file that is about to be written; its entry is only recorded once written() confirms it
+        """
+        self._pending[output_file] = entry
+
+    def written(self, output_file):
+        entry = self._pending.pop(output_file)
+        entry['written_at'] = datetime.datetime.now(tz=datetime.timezone.utc).isoformat()
+        self.entries[output_file] = entry
+
+    def stale(self, output_format, starttime, endtime):
+        """
+        Files from earlier runs, for buckets that lie inside this run's window, that this run had no observations for
+        These usually mean the observations that were in them have since gone away
+        """
+        return sorted(output_file for output_file, entry in self.entries.items()
+                      if output_file not in self.seen and entry['format'] == output_format
+                      and entry['bucket_start'] >= starttime and entry['bucket_end'] <= endtime)
+
+    def save(self):
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump({'version': self.VERSION, 'files': self.entries}, f, indent=1, sort_keys=True)
+        os.replace(self.path + '.tmp', self.path)
+
+
+def report_stale(manifest, output_format, starttime, endtime, report):
+    """
+    Save the manifest and warn about files from earlier runs in this window that this run had no observations for
+    """
+    if manifest is None:
+        return
+    manifest.save()
+    stale = manifest.stale(output_format, starttime, endtime)
+    report.count('stale_files', len(stale))
+    for output_file in stale:
+        print(f"WARNING: {output_file} was written by an earlier run but has no observations in this one")
+
+
+def check_manifest(manifest, segment, mission_name, curtime, bucket_hours, output_format, writer_options, report):
+    """
+    Decide whether a bucket needs writing, noting it in the manifest if it does
+    :return: True if the bucket's file is already up to date
+    """
+    output_file = WRITERS[output_format].output_file(mission_name, curtime, bucket_hours)
+    input_hash = OutputManifest.input_hash(segment)
+    settings_hash = OutputManifest.settings_hash(output_format, bucket_hours, writer_options)
+    if manifest.is_current(output_file, input_hash, settings_hash):
+        print(f"{output_file} is unchanged; skipping")
+        report.count('buckets_unchanged')
+        return True
+
+    manifest.expect(output_file, {
+        'mission': mission_name,
+        'format': output_format,
+        'bucket_start': curtime,
+        'bucket_end': curtime + bucket_hours * 60 * 60,
+        'observations': len(segment),
+        'input_hash': input_hash,
+        'settings_hash': settings_hash,
+    })
+    return False
+
+
+def output_data(accumulated_observations, mission_name, starttime, bucket_hours, output_format='prepbufr', executor=None,
+                writer_options=None, report=None, manifest=None):
+    """
+    Split observations into buckets and write each to its own file
+    If an executor is given, the buckets are handed to it to write rather than written here
+    If a manifest is given, buckets whose file is already up to date are skipped
+    :return: a dict of future -> output file for each bucket handed to the executor
+    """
+    report = report or RunReport()
+    with report.stage('sorting'):
+        accumulated_observations = accumulated_observations.sort_by_time()
+
+    if (accumulated_observations['timestamp'][0] < starttime):
+        print("WTF, how can we have gotten data from before the starttime?")
+
+    futures = {}
+    for curtime, start_index, end_index in bucket_segments(accumulated_observations['timestamp'], bucket_hours):
+        segment = accumulated_observations[start_index:end_index]
+        if manifest is not None and check_manifest(manifest, segment, mission_name, curtime, bucket_hours,
+                                                   output_format, writer_options, report):
+            continue
+        if executor is None:
+            stats = write_segment(segment, mission_name, curtime, bucket_hours, output_format, writer_options)
+            report.record_bucket(stats)
+            if manifest is not None:
+                manifest.written(stats['output_file'])
+        else:
+            future = executor.submit(write_segment, segment, mission_name, curtime, bucket_hours, output_format,
+                                     writer_options)
+            futures[future] = WRITERS[output_format].output_file(mission_name, curtime, bucket_hours)
+    return futures
+
+
+def wait_for_writes(futures, report=None, manifest=None):
+    """
+    Wait for buckets handed to a worker pool to be written, reporting any that failed
+    :return: the number of buckets that failed
+    """
+    failures = 0
+    for future in concurrent.futures.as_completed(futures):
+        error = future.exception()
+        if error is not None:
+            failures += 1
+            print(f"ERROR: failed to write {futures[future]}: {error!r}")
+            continue
+        if report is not None:
+            report.record_bucket(future.result())
+        if manifest is not None:
+            manifest.written(futures[future])
+    if report is not None:
+        report.count('bucket_failures', failures)
+    return failures
+
+
+"""
+In this section, we have the continuous polling mode
+Rather than fetching a fixed window and exiting, this keeps polling the API, holding each mission's buckets in memory
+and writing each bucket's file as soon as the data has moved past it
+"""
+
+
+class SpillStore:
+    """
+    Keeps observations on disk, in a temporary directory, under a key such as (mission name, bucket start)
+    Observations added under the same key are all handed back together by load()
+    """
+
+    def __init__(self, directory=None):
+        self._directory = tempfile.TemporaryDirectory(prefix='wb_to_prepbufr_spill_', dir=directory)
+        self._files = {}
+        self.mission_names = []
+
+    def add(self, key, observations):
+        path = os.path.join(self._directory.name, f"{sum(map(len, self._files.values()))}.npy")
+        np.save(path, observations.data)
+        self._files.setdefault(key, []).append(path)
+        self.mission_names = observations.mission_names
+
+    def load(self, key):
+        return Observations(np.concatenate([np.load(path) for path in self._files[key]]), self.mission_names)
+
+    def close(self):
+        self._directory.cleanup()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class BucketBuffer:
+    """
+    Holds observations in fixed (mission, bucket) slots aligned to multiples of bucket_hours
+    A bucket is written once the latest observation seen is late_hours past its end; if a late observation
+    arrives for a bucket that was already written, only that bucket is rewritten
+    Written buckets are kept for retain_hours so they can be rewritten, then dropped from memory
+    If a SpillStore is given, dropped buckets are moved to it instead, along with any late observations for them,
+    and finish() rewrites those buckets from disk
+    With deduplicate, repeats of the same (mission, timestamp) are dropped when a bucket is written, as polling
+    fetches them again when it rebuilds open buckets after a restart
+    With retry_failed, a bucket that fails to write is reported and left as it was, to be tried again on the next
+    call to write_closed, rather than raising
+    """
+
+    def __init__(self, bucket_hours, output_format='prepbufr', combine_missions=False, late_hours=0.5, retain_hours=24,
+                 writer_options=None, report=None, manifest=None, spill=None, deduplicate=True, retry_failed=False):
+        self.report = report or RunReport()
+        self.deduplicate = deduplicate
+        self.retry_failed = retry_failed
+        self.manifest = manifest
+        self.spill = spill
+        self.bucket_hours = bucket_hours
+        self.output_format = output_format
+        self.writer_options = writer_options
+        self.combine_missions = combine_missions
+        self.late_seconds = late_hours * 60 * 60
+        self.retain_seconds = retain_hours * 60 * 60
+
+        # (mission name, bucket start) -> list of Observations
+        self.buckets = {}
+        self.dirty = set()
+        self.written = set()
+        self.spilled_late = set()
+        self.latest_time = None
+
+    @property
+    def bucket_seconds(self):
+        return int(round(self.bucket_hours * 60 * 60))
+
+    def add(self, observations):
+        if len(observations) == 0:
+            return
+        latest = int(observations['timestamp'].max())
+        self.latest_time = latest if self.latest_time is None else max(self.latest_time, latest)
+
+        if self.combine_missions:
+            by_mission = {'all': observations}
+        else:
+            by_mission = observations.split_by_mission()
+
+        for mission_name, mission_observations in by_mission.items():
+            timestamps = mission_observations['timestamp']
+            bucket_starts = timestamps - timestamps % self.bucket_seconds
+            for bucket_start in np.unique(bucket_starts):
+                key = (mission_name, bucket_start.item())
+                if key in self.written and key not in self.buckets and self.spill is not None:
+                    self.spill.add(key, mission_observations[bucket_starts == bucket_start])
+                    self.spilled_late.add(key)
+                    self.report.count('observations_spilled', int(np.sum(bucket_starts == bucket_start)))
+                    continue
+                if key in self.written and key not in self.buckets:
+                    output_file = WRITERS[self.output_format].output_file(mission_name, key[1], self.bucket_hours)
+                    print(f"Dropping late observation(s) for {output_file}, "
+                          f"which is older than the retention window")
+                    continue
+                self.buckets.setdefault(key, []).append(mission_observations[bucket_starts == bucket_start])
+                self.dirty.add(key)
+
+    def open_since(self):
+        """
+        The start of the earliest bucket that hasn't been written yet, or None if there is none
+        """
+        unwritten = [key[1] for key in self.buckets if key not in self.written]
+        return min(unwritten) if unwritten else None
+
+    def _write(self, key, parts):
+        mission_name, bucket_start = key
+        segment = Observations.concatenate(parts)
+        if self.deduplicate:
+            segment = segment.drop_duplicates()
+        segment = segment.sort_by_time()
+        if self.manifest is None or not check_manifest(self.manifest, segment, mission_name, bucket_start,
+                                                       self.bucket_hours, self.output_format, self.writer_options,
+                                                       self.report):
+            stats = write_segment(segment, mission_name, bucket_start, self.bucket_hours, self.output_format,
+                                  self.writer_options)
+            self.report.record_bucket(stats)
+            if self.manifest is not None:
+                self.manifest.written(stats['output_file'])
+                self.manifest.save()
+        return segment
+
+    def write_closed(self, final=False):
+        """
+        Write every bucket that has closed and changed since it was last written, and forget old buckets
+        :param final: write every changed bucket, closed or not, as no more observations are coming
+        """
+        if self.latest_time is None:
+            return
+
+        for key in sorted(self.dirty):
+            if not final and key[1] + self.bucket_seconds + self.late_seconds > self.latest_time:
+                continue
+            try:
+                self.buckets[key] = [self._write(key, self.buckets[key])]
+            except Exception as e:
+                if not self.retry_failed:
+                    raise
+                output_file = WRITERS[self.output_format].output_file(key[0], key[1], self.bucket_hours)
+                print(f"ERROR: failed to write {output_file}: {e!r}; trying again next time")
+                self.report.count('bucket_failures')
+                continue
+            self.dirty.discard(key)
+            self.written.add(key)
+
+        for key in list(self.buckets):
+            if key in self.written and key not in self.dirty and \
+                    key[1] + self.bucket_seconds + self.retain_seconds <= self.latest_time:
+                if self.spill is not None:
+                    self.spill.add(key, self.buckets[key][0])
+                del self.buckets[key]
+
+    def finish(self):
+        """
+        Write every bucket that is left, then rewrite the buckets that late observations were spilled for
+        """
+        self.write_closed(final=True)
+        for key in sorted(self.spilled_late):
+            self._write(key, [self.spill.load(key)])
+        self.spilled_late.clear()
+
+
+def load_cursor(cursor_file):
+    if not os.path.exists(cursor_file):
+        return None
+    with open(cursor_file) as f:
+        return json.load(f)
+
+
+def save_cursor(cursor_file, cursor):
+    # write to a temporary file first, so a crash mid-write doesn't lose the cursor
+    with open(cursor_file + '.tmp', 'w') as f:
+        json.dump(cursor, f)
+    os.replace(cursor_file + '.tmp', cursor_file)
+
+
+def poll(client, starttime, bucket_hours, poll_seconds, cursor_file, output_format='prepbufr', combine_missions=False,
+         late_hours=0.5, retain_hours=24, writer_options=None, report=None, manifest=None):
+    """
+    Keep polling the API for new observations, writing each bucket as soon as it closes
+    Progress is saved to cursor_file after every poll. On restart, if buckets were still open, the API is
+    queried again from the start of the earliest of them so they can be rebuilt; otherwise polling picks up
+    from the saved next_page
+    """
+
+    import requests
+
+    report = report or RunReport()
+    buffer = BucketBuffer(bucket_hours, output_format, combine_missions, late_hours, retain_hours, writer_options,
+                          report, manifest, retry_failed=True)
+    collector = ObservationCollector()
+
+    cursor = load_cursor(cursor_file)
+    if cursor is None:
+        next_page = super_observations_url(starttime)
+    elif cursor['open_since'] is not None:
+        starttime = cursor['open_since']
+        next_page = super_observations_url(starttime)
+        print(f"Resuming from {cursor_file}, rebuilding buckets open since {starttime}")
+    else:
+        starttime = cursor['max_time'] if cursor['max_time'] is not None else starttime
+        next_page = cursor['next_page'] or super_observations_url(starttime)
+        print(f"Resuming from {cursor_file}")
+
+    while True:
+        last_page = None
+        pages = client.iter_pages(next_page, lambda page: next_super_observations_url(page, starttime))
+        try:
+            with report.stage('paging'):
+                for next_page, observations_page in pages:
+                    # a quiet poll is expected, so empty pages aren't warned about
+                    collect_page(collector, next_page, observations_page, report, warn_empty=False)
+                    last_page = observations_page
+        except requests.RequestException as e:
+            # keep the pages that did arrive; the next poll picks up from the page that failed
+            print(f"ERROR: poll failed ({e!r}); trying again in {poll_seconds}s")
+            report.count('poll_failures')
+
+        with report.stage('grouping'):
+            buffer.add(collector.drain())
+        buffer.write_closed()
+
+        # new data will show up after the last page we saw
+        if last_page is not None and last_page.get('next_page'):
+            next_page = next_super_observations_url(last_page, starttime, poll=True)
+        elif last_page is not None and buffer.latest_time is not None:
+            next_page = super_observations_url(buffer.latest_time)
+
+        save_cursor(cursor_file, {
+            'next_page': next_page,
+            'max_time': buffer.latest_time,
+            'open_since': buffer.open_since(),
+        })
+        report.count('polls')
+        report.write()
+        time.sleep(poll_seconds)
+
+def shard_window(starttime, endtime, shard_hours):
+    """
+    Split the window into consecutive (start, end) ranges of at most shard_hours each
+    Neighbouring shards share their edge, so nothing on a boundary is missed; fetch_window drops the repeats
+    """
+    shard_seconds = max(1, int(shard_hours * 60 * 60))
+    edges = list(range(starttime, endtime, shard_seconds)) + [endtime]
+    return list(zip(edges[:-1], edges[1:])) or [(starttime, endtime)]
+
+
+def collect_page(collector, url, observations_page, report, warn_empty=True):
+    """
+    Add a page from the API to a collector, printing and counting what was in it
+    """
+    print(url)
+    if warn_empty and (len(observations_page['observations']) == 0):
+        print("Could not find any observations for the input date range!!!!")
+    print(f"Fetched page with {len(observations_page['observations'])} observation(s)")
+    report.count('observations_fetched', len(observations_page['observations']))
+    with report.stage('parsing'):
+        dropped = collector.add_page(observations_page['observations'])
+    if dropped > 0:
+        print(f"got {dropped} ob(s) without a mission name???")
+        report.count('observations_dropped_no_mission', dropped)
+
+
+def fetch_window(client, starttime, endtime, shard_hours=None, fetch_workers=4, report=None):
+    """
+    Fetch every observation between starttime and endtime
+    If shard_hours is set, the window is split into shards of that length which are paged concurrently, by up to
+    fetch_workers threads, and joined back together in time order
+    :return: the observations, in the order they were fetched
+    """
+    report = report or RunReport()
+    collector = ObservationCollector()
+
+    # This line here would just find W-1594, useful for testing/debugging
+    #next_page = f"https://sensor-data.windbornesystems.com/api/v1/super_observations.json?mission_id=c8108dd5-bcf5-45ec-be80-a1da5e382e99&min_time={starttime}&max_time={endtime}&include_mission_name=true"
+
+    # Note that we query superobservations, which are described here:
+    # https://windbornesystems.com/docs/api#super_observations
+    # We find that for most NWP applications this leads to better performance than overwhelming with high-res data
+    # The client fetches the following page in the background while this one is being parsed
+    def collect_shard(shard_collector, shard_start, shard_end):
+        pages = client.iter_pages(super_observations_url(shard_start, shard_end),
+                                  lambda page: next_super_observations_url(page, shard_start, shard_end))
+        for next_page, observations_page in pages:
+            collect_page(shard_collector, next_page, observations_page, report)
+        return shard_collector.observations()
+
+    edges = []
+    if shard_hours is None:
+        with report.stage('paging'):
+            collect_shard(collector, starttime, endtime)
+    else:
+        # each shard is paged to the end and packed into columns by a worker, so shards that finish early wait
+        # as arrays rather than pages of JSON, and are then joined here in time order
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=fetch_workers)
+        windows = shard_window(starttime, endtime, shard_hours)
+        edges = [shard_end for _, shard_end in windows[:-1]]
+        futures = [executor.submit(collect_shard, ObservationCollector(), *shard) for shard in windows]
+        try:
+            with report.stage('paging'):
+                for future in futures:
+                    collector.add_observations(future.result())
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    observations = collector.observations()
+    if len(edges) > 0:
+        # observations on the edge between two shards are fetched by both; only those are deduplicated, so that
+        # everything else comes out exactly as it would from a single stream of pages
+        on_edge = np.flatnonzero(np.isin(observations['timestamp'], edges))
+        _, first = np.unique(observations.data[on_edge][['mission', 'timestamp']], return_index=True)
+        keep = np.ones(len(observations), dtype=bool)
+        keep[on_edge] = False
+        keep[on_edge[first]] = True
+        if not keep.all():
+            print(f"Dropped {len(keep) - keep.sum()} observation(s) fetched by more than one shard")
+            report.count('observations_duplicated', int(len(keep) - keep.sum()))
+            observations = observations[keep]
+    return observations
+
+
+def convert_window(client, starttime, endtime, bucket_hours, output_format='prepbufr', combine_missions=False, jobs=1,
+                   writer_options=None, report=None, manifest=None, shard_hours=None, fetch_workers=4):
+    """
+    Fetch every observation between starttime and endtime and write them out in buckets
+    If a manifest is given, buckets whose files are already up to date are skipped, and files from earlier runs
+    that this one no longer produces are reported as stale
+    :return: the number of buckets that failed to write
+    """
+    report = report or RunReport()
+    accumulated_observations = fetch_window(client, starttime, endtime, shard_hours, fetch_workers, report)
+    if len(accumulated_observations) == 0:
+        print("No observations found")
+        return 0
+
+    executor = None
+    if jobs > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
+
+    futures = {}
+    if (combine_missions):
+        mission_name = 'all'
+        futures.update(output_data(accumulated_observations, mission_name, starttime, bucket_hours, output_format,
+                                   executor=executor, writer_options=writer_options, report=report,
+                                   manifest=manifest))
     else:
-        print(f"Converting {len(segment)} observation(s) to prepbufr and saving as {output_file}")
-        convert_to_prepbufr(segment, curtime + datetime.timedelta(hours=bucket_hours / 2).seconds, output_file)
+        with report.stage('grouping'):
+            by_mission = accumulated_observations.split_by_mission()
+        for mission_name, mission_observations in by_mission.items():
+           futures.update(output_data(mission_observations, mission_name, starttime, bucket_hours, output_format,
+                                      executor=executor, writer_options=writer_options, report=report,
+                                      manifest=manifest))
+
+    failures = 0
+    if executor is not None:
+        with report.stage('waiting_for_writers'):
+            failures = wait_for_writes(futures, report, manifest)
+        executor.shutdown()
+        if failures > 0:
+            print(f"{failures} of {len(futures)} file(s) failed to write")
+
+    report_stale(manifest, output_format, starttime, endtime, report)
+    return failures
+
+
+def convert_stream(client, starttime, endtime, bucket_hours, output_format='prepbufr', combine_missions=False,
+                   late_hours=0.5, writer_options=None, report=None, manifest=None, spill_dir=None):
+    """
+    Fetch every observation between starttime and endtime, writing each bucket as soon as the pages have moved
+    late_hours past its end rather than holding the whole window in memory
+    Buckets are aligned as they are with --poll. Written buckets, and any observations that turn up for them
+    afterwards, are kept in a temporary directory under spill_dir, and the buckets that got late observations
+    are rewritten at the end
+    """
+    report = report or RunReport()
+    collector = ObservationCollector()
+
+    with SpillStore(spill_dir) as spill:
+        # every page is fetched once, so like the batch path, nothing fetched is dropped as a repeat
+        buffer = BucketBuffer(bucket_hours, output_format, combine_missions, late_hours, 0, writer_options, report,
+                              manifest, spill, deduplicate=False)
+        pages = client.iter_pages(super_observations_url(starttime, endtime),
+                                  lambda page: next_super_observations_url(page, starttime, endtime))
+        while True:
+            with report.stage('paging'):
+                next_page, observations_page = next(pages, (None, None))
+            if observations_page is None:
+                break
+            collect_page(collector, next_page, observations_page, report)
+            with report.stage('grouping'):
+                buffer.add(collector.drain())
+            buffer.write_closed()
+        buffer.finish()
+
+    if buffer.latest_time is None:
+        print("No observations found")
+    report_stale(manifest, output_format, starttime, endtime, report)
+    return 0
+
+
+"""
+In this section, we provide an API for converting observations from inside another program, rather than by
+running this script once per window. A Converter keeps what it loads between calls, so converting many small
+batches doesn't pay for imports, finding and checking the BUFR table, or the error model, on each of them
+"""
+
+DEFAULT_TABLE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'prepbufr_config.table')
+
+
+class Converter:
+    """
+    Converts observations to prepbufr or ISARRA NetCDF files, splitting them into the same per-mission time
+    buckets as the command line does. For example:
+        converter = Converter('prepbufr', bucket_hours=6, output_dir='/data/prepbufr')
+        for batch in batches:
+            converter.write(batch)
+    Observations can be given in any of the shapes to_observations takes
+    """
+
+    def __init__(self, output_format='prepbufr', bucket_hours=6.0, output_dir='.', combine_missions=False,
+                 table=None, subsets_per_message=2, error_model=None, netcdf_append=False, thinning=None,
+                 quality_control=None, verify=False, report=None):
+        """
+        :param table: BUFR table for prepbufr output; by default, the one next to this script
+        :param error_model: ObservationErrorModel, or the path of an errtable to load one from
+        :param thinning: Thinning to apply to each bucket before it's written
+        :param quality_control: QualityControl for prepbufr output, if not the default limits
+        :param verify: read each prepbufr file back after writing it and check it, recording the result in report
+        :param report: RunReport to record each file written in
+        """
+        if output_format not in WRITERS:
+            raise ValueError(f"Unknown output format {output_format!r}; choose from {sorted(WRITERS)}")
+        if combine_missions and output_format != 'prepbufr':
+            raise ValueError("Missions can only be combined into prepbufr files")
+
+        self.output_format = output_format
+        self.bucket_hours = bucket_hours
+        self.output_dir = output_dir
+        self.combine_missions = combine_missions
+        self.report = report or RunReport()
+
+        self.writer_options = {}
+        if output_format == 'prepbufr':
+            # import the writer's library once up front, so a missing install fails here rather than on the
+            # first write, and no write pays for the import
+            importlib.import_module('ncepbufr')
+
+            table = os.path.abspath(table or DEFAULT_TABLE)
+            if not os.path.exists(table):
+                raise FileNotFoundError(f"BUFR table {table} does not exist")
+            if isinstance(error_model, str):
+                error_model = ObservationErrorModel.from_errtable(error_model)
+            self.writer_options = {
+                'table': table,
+                'subsets_per_message': subsets_per_message,
+                'error_model': error_model or ObservationErrorModel.default(),
+                'quality_control': quality_control or QualityControl(),
+                'verify': verify,
+            }
+        elif output_format == 'netcdf':
+            importlib.import_module('netCDF4')
+
+            self.writer_options = {'append': netcdf_append}
+        if thinning is not None:
+            self.writer_options['thinning'] = thinning
+
+    def write(self, observations, mission_names=None, output_dir=None):
+        """
+        Write observations to files, one per mission (unless combined) and time bucket
+        :param output_dir: where to write them, if not in the converter's output_dir
+        :return: the paths of the files written
+        """
+        observations = to_observations(observations, mission_names)
+        if len(observations) == 0:
+            return []
+
+        if self.combine_missions:
+            by_mission = {'all': observations}
+        else:
+            by_mission = observations.split_by_mission()
+
+        output_files = []
+        for mission_name, mission_observations in by_mission.items():
+            mission_observations = mission_observations.sort_by_time()
+            for curtime, start_index, end_index in bucket_segments(mission_observations['timestamp'],
+                                                                   self.bucket_hours):
+                stats = write_segment(mission_observations[start_index:end_index], mission_name, curtime,
+                                      self.bucket_hours, self.output_format, self.writer_options,
+                                      output_dir or self.output_dir)
+                self.report.record_bucket(stats)
+                output_files.append(stats['output_file'])
+        return output_files
+
+    def products(self, observations, mission_names=None):
+        """
+        Convert observations without keeping any files, for callers that want to send the products on themselves
+        :return: a dict of file name -> contents for each file that would have been written, including indexes
+        """
+        with tempfile.TemporaryDirectory(prefix='wb_to_prepbufr_') as output_dir:
+            self.write(observations, mission_names, output_dir)
+            products = {}
+            for name in sorted(os.listdir(output_dir)):
+                with open(os.path.join(output_dir, name), 'rb') as f:
+                    products[name] = f.read()
+            return products
+
 
 def main():
     """
@@ -470,8 +2485,83 @@ def main():
                         help='Number of hours of observations to accumulate into a file before opening the next file')
     parser.add_argument('-c', '--combine_missions', action='store_true',
                         help="If selected, all missions are combined in the same output file, only used for bufr.")
+    parser.add_argument('-f', '--format', choices=sorted(WRITERS), default='prepbufr',
+                        help="Output format to write.")
     parser.add_argument('-nc', '--netcdf_output', action='store_true',
-                        help="If selected, data is output in netcdf format following conventions for ISARRA.")
+                        help="If selected, data is output in netcdf format following conventions for ISARRA.\n"
+                             "Same as --format netcdf.")
+    parser.add_argument('--subsets_per_message', type=int, default=2,
+                        help="Number of ADPUPA subsets to pack into each BUFR message (each observation is two subsets).\n"
+                             "The default of 2 writes one observation per message; larger values give smaller files.")
+    parser.add_argument('--error_table',
+                        help="GSI errtable file to take observation errors from (the radiosonde blocks, 120 and 220).\n"
+                             "By default, the radiosonde errors built into this script are used.")
+    parser.add_argument('--qc_temperature_range', type=float, nargs=2, default=(-100., 60.), metavar=('MIN', 'MAX'),
+                        help="Temperatures (C) outside this range are marked as rejected (TQM 13).")
+    parser.add_argument('--qc_max_relative_humidity', type=float, default=110.,
+                        help="Relative humidities (%%) above this are marked as rejected (QQM 13).")
+    parser.add_argument('--qc_max_wind_speed', type=float, default=150.,
+                        help="Winds faster than this (m/s) are marked as rejected (WQM 13).")
+    parser.add_argument('--qc_pressure_range', type=float, nargs=2, default=(1., 1100.), metavar=('MIN', 'MAX'),
+                        help="Pressures (hPa) outside this range are marked as rejected (PQM 13).")
+    parser.add_argument('--qc_max_pressure_altitude_mismatch', type=float, default=0.25,
+                        help="If pressure and the pressure estimated from altitude differ by more than this in log\n"
+                             "pressure (0.25 is roughly 2 km), both are marked as rejected (PQM and ZQM 13).\n"
+                             "Observations left with nothing usable aren't written.")
+    parser.add_argument('--verify', action='store_true',
+                        help="If selected, read each prepbufr file back after writing it and check it against the\n"
+                             "observations it was written from. Any mismatch is reported, and the run exits with an error.")
+    parser.add_argument('--thin_degrees', type=float,
+                        help="If set, thin observations before writing them to one per bin of this many degrees of\n"
+                             "latitude and longitude, --thin_hpa of pressure and --thin_minutes of time.")
+    parser.add_argument('--thin_hpa', type=float, default=25.0,
+                        help="With --thin_degrees, the thickness of the pressure layers to bin by (0 to not bin by pressure).")
+    parser.add_argument('--thin_minutes', type=float, default=60.0,
+                        help="With --thin_degrees, the length of time to bin by (0 to not bin by time).")
+    parser.add_argument('--thin_method', choices=Thinning.METHODS, default='first',
+                        help="With --thin_degrees, whether to keep the first observation in each bin or average them.")
+    parser.add_argument('--netcdf_append', action='store_true',
+                        help="If selected, netcdf files that already exist are added to rather than rewritten;\n"
+                             "only observations whose times aren't in the file yet are written.")
+    parser.add_argument('--manifest', action='store_true',
+                        help=f"If selected, keep a manifest ({MANIFEST_FILE}) of the files written, skip buckets whose\n"
+                             "observations and settings haven't changed since they were written, and warn about files\n"
+                             "from earlier runs that this run has no observations for.")
+    parser.add_argument('--report',
+                        help="Write a JSON report of timings and counters for each stage of the run to this file.")
+    parser.add_argument('--prometheus_textfile',
+                        help="Also write the run's timings and counters to this file in Prometheus textfile format.\n"
+                             "With --poll, both reports are rewritten after every poll.")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="Number of worker processes to write files with; each bucket's file is written by one worker.")
+    parser.add_argument('--shard_hours', type=float,
+                        help="If set, split the time range into shards of this many hours and page through them\n"
+                             "concurrently, rather than as one long sequence of pages. Useful for long backfills.")
+    parser.add_argument('--fetch_workers', type=int, default=4,
+                        help="With --shard_hours, the number of shards to page through at once.")
+    parser.add_argument('--stream', action='store_true',
+                        help="If selected, write each bucket as soon as the pages have moved --late_hours past it,\n"
+                             "so memory use depends on the bucket size rather than the length of the time range.\n"
+                             "Buckets are aligned as they are with --poll.")
+    parser.add_argument('--spill_dir',
+                        help="With --stream, where to keep written buckets and late observations on disk\n"
+                             "(a temporary directory in the system default location if not set).")
+    parser.add_argument('--cache_dir',
+                        help="If set, API pages are cached in this directory and reused by later runs over the same window.\n"
+                             "The last page of a window is only cached once the window ended 6 hours ago.")
+    parser.add_argument('--cache_max_mb', type=float, default=1024,
+                        help="Size the page cache is kept under, evicting the least recently used pages first.")
+    parser.add_argument('--offline', action='store_true',
+                        help="If selected, pages are replayed from --cache_dir without contacting the API.")
+    parser.add_argument('--poll', type=float, metavar='SECONDS',
+                        help="If set, keep polling the API every SECONDS for new data instead of exiting, writing each \n"
+                             "bucket's file as soon as the data has moved past it. Only a start time should be given.")
+    parser.add_argument('--cursor_file', default='wb_to_prepbufr_cursor.json',
+                        help="Where --poll saves its progress, so a restart picks up where it left off.")
+    parser.add_argument('--late_hours', type=float, default=0.5,
+                        help="With --poll or --stream, how long past the end of a bucket to wait for stragglers before writing it.")
+    parser.add_argument('--retain_hours', type=float, default=24,
+                        help="With --poll, how long to keep written buckets in memory so late data can rewrite them.")
     args = parser.parse_args()
 
     if (len(args.times) == 1):
@@ -487,60 +2577,88 @@ def main():
         print("error processing input args, one or two arguments are needed")
         exit(1)
 
-    if (not "WB_CLIENT_ID" in os.environ) or (not "WB_API_KEY" in os.environ) :
-        print("  ERROR: You must set environment variables WB_CLIENT_ID and WB_API_KEY\n"
-              "  If you don't have a client ID or API key, please contact WindBorne.")
+    if args.poll is not None and len(args.times) != 1:
+        print("error processing input args, --poll only takes a start time")
         exit(1)
 
-    args = parser.parse_args()
-    bucket_hours = args.bucket_hours
-
-    observations_by_mission = {}
-    accumulated_observations = []
-    has_next_page = True
+    if args.shard_hours is not None and (args.shard_hours <= 0 or args.fetch_workers < 1):
+        print("error processing input args, --shard_hours and --fetch_workers must be positive")
+        exit(1)
 
-    # This line here would just find W-1594, useful for testing/debugging
-    #next_page = f"https://sensor-data.windbornesystems.com/api/v1/super_observations.json?mission_id=c8108dd5-bcf5-45ec-be80-a1da5e382e99&min_time={starttime}&max_time={endtime}&include_mission_name=true"
+    if args.stream and (args.poll is not None or args.jobs > 1 or args.shard_hours is not None):
+        print("error processing input args, --stream writes buckets as it fetches them, "
+              "so it can't be used with --poll, --jobs or --shard_hours")
+        exit(1)
 
-    next_page = f"https://sensor-data.windbornesystems.com/api/v1/super_observations.json?min_time={starttime}&max_time={endtime}&include_mission_name=true"
-    netcdf_output = args.netcdf_output
-
-    while has_next_page:
-        # Note that we query superobservations, which are described here:
-        # https://windbornesystems.com/docs/api#super_observations
-        # We find that for most NWP applications this leads to better performance than overwhelming with high-res data
-        print(next_page)
-        observations_page = wb_get_request(next_page)
-        has_next_page = observations_page["has_next_page"]
-        if (len(observations_page['observations']) == 0):
-            print("Could not find any observations for the input date range!!!!")
-        if has_next_page:
-            next_page = observations_page["next_page"]+"&include_mission_name=true&min_time={}&max_time={}".format(starttime,endtime)
-        print(f"Fetched page with {len(observations_page['observations'])} observation(s)")
-        for observation in observations_page['observations']:
-            if 'mission_name' not in observation:
-                print("got an ob without a mission name???")
-                continue
-            elif observation['mission_name'] not in observations_by_mission:
-                observations_by_mission[observation['mission_name']] = []
+    if args.poll is not None and (args.jobs > 1 or args.shard_hours is not None):
+        print("error processing input args, --poll writes buckets one at a time as the data arrives, "
+              "so it can't be used with --jobs or --shard_hours")
+        exit(1)
 
-            observations_by_mission[observation['mission_name']].append(observation)
-            accumulated_observations.append(observation)
+    if args.poll is not None and args.cache_dir is not None:
+        print("error processing input args, --poll keeps re-requesting the latest page for new data, "
+              "so it can't be used with --cache_dir")
+        exit(1)
 
-            # alternatively, you could call `time.sleep(60)` and keep polling here
-            # (though you'd have to move where you were calling convert_to_prepbufr)
+    if args.offline and args.cache_dir is None:
+        print("  ERROR: --offline replays pages from the cache, so --cache_dir must be set")
+        exit(1)
 
+    if not args.offline and ((not "WB_CLIENT_ID" in os.environ) or (not "WB_API_KEY" in os.environ)) :
+        print("  ERROR: You must set environment variables WB_CLIENT_ID and WB_API_KEY\n"
+              "  If you don't have a client ID or API key, please contact WindBorne.")
+        exit(1)
 
-    if len(observations_by_mission) == 0:
-        print("No observations found")
-        return
+    args = parser.parse_args()
+    bucket_hours = args.bucket_hours
 
-    if (args.combine_missions):
-        mission_name = 'all'
-        output_data(accumulated_observations, mission_name, starttime, bucket_hours)
-    else:
-        for mission_name, accumulated_observations in observations_by_mission.items():
-           output_data(accumulated_observations, mission_name, starttime, bucket_hours, netcdf_output)
+    cache = None
+    if args.cache_dir is not None:
+        cache = PageCache(args.cache_dir, max_bytes=int(args.cache_max_mb * 1024 * 1024))
+    report = RunReport(args.report, args.prometheus_textfile)
+    client = WindBorneClient(cache=cache, offline=args.offline, report=report,
+                             pool_maxsize=max(10, args.fetch_workers))
+
+    # missions are only ever combined into prepbufr files
+    output_format = 'netcdf' if args.netcdf_output else args.format
+    if args.combine_missions:
+        output_format = 'prepbufr'
+
+    writer_options = {}
+    if output_format == 'netcdf':
+        writer_options['append'] = args.netcdf_append
+    if output_format == 'prepbufr':
+        writer_options['subsets_per_message'] = args.subsets_per_message
+        writer_options['verify'] = args.verify
+        writer_options['quality_control'] = QualityControl(
+            tuple(args.qc_temperature_range), args.qc_max_relative_humidity, args.qc_max_wind_speed,
+            tuple(args.qc_pressure_range), args.qc_max_pressure_altitude_mismatch)
+        if args.error_table is not None:
+            writer_options['error_model'] = ObservationErrorModel.from_errtable(args.error_table)
+
+    if args.thin_degrees is not None:
+        writer_options['thinning'] = Thinning(args.thin_degrees, args.thin_hpa, args.thin_minutes, args.thin_method)
+
+    manifest = OutputManifest() if args.manifest else None
+
+    try:
+        if args.poll is not None:
+            poll(client, starttime, bucket_hours, args.poll, args.cursor_file, output_format, args.combine_missions,
+                 args.late_hours, args.retain_hours, writer_options, report, manifest)
+        elif args.stream:
+            convert_stream(client, starttime, endtime, bucket_hours, output_format, args.combine_missions,
+                           args.late_hours, writer_options, report, manifest, args.spill_dir)
+        else:
+            failures = convert_window(client, starttime, endtime, bucket_hours, output_format, args.combine_missions,
+                                      args.jobs, writer_options, report, manifest, args.shard_hours,
+                                      args.fetch_workers)
+            if failures > 0:
+                exit(1)
+        if report.counters['verify_mismatches'] > 0:
+            print(f"{report.counters['verify_mismatches']} value(s) didn't match when read back")
+            exit(1)
+    finally:
+        report.write()
 
 if __name__ == '__main__':
     main()